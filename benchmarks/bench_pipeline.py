@@ -0,0 +1,230 @@
+"""
+
+Benchmarks the search -> fetch -> download -> archive pipeline against
+the local fake Gmail API. Everything runs in a temporary home folder
+(with its own config, download index and journal), so real settings,
+tokens and downloads are never touched.
+
+    python benchmarks/bench_pipeline.py --messages 500 --latency 0.05
+
+With --history-sync the messages are listed with the History API
+(history.list) from the fake mailbox's first history ID, and checked
+against the query locally, instead of searched for.
+
+Results are printed as JSON (add --output to also save them), so runs
+before and after a change can be compared.
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses the benchmark options."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--messages", type=int, default=200, help="mailbox size")
+    parser.add_argument(
+        "--size", type=int, default=200_000, help="attachment size in bytes"
+    )
+    parser.add_argument(
+        "--attachments", type=int, default=1, help="attachments per message"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per round trip"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of calls failing (503)"
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="fraction of calls rate limited (429)",
+    )
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.0,
+        help="fraction of messages that are re-sent copies",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="download workers")
+    parser.add_argument("--batch-size", type=int, default=50, help="messages per batch")
+    parser.add_argument("--page-size", type=int, default=100, help="list page size")
+    parser.add_argument(
+        "--quota", type=float, default=250, help="quota units per second"
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="run the stages at the same time (pipeline mode)",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=50, help="pipeline queue size"
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=("none", "file", "folder"),
+        default="none",
+        help="when written files are synced to disk",
+    )
+    parser.add_argument(
+        "--history-sync",
+        action="store_true",
+        help="list the messages with the History API instead of searching",
+    )
+    parser.add_argument(
+        "--no-field-masks",
+        action="store_true",
+        help="request full API responses",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="report the peak Python heap (slows the run down)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", type=Path, help="also write the results here")
+    return parser.parse_args(argv)
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes (0 if unknown)."""
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class FakeSession:
+    """Stands in for the Gmail API session, every thread shares the fake."""
+
+    def __init__(self, gmail) -> None:
+        self.gmail = gmail
+
+    def service(self):
+        return self.gmail
+
+
+def run_pipeline(args, home: Path) -> dict:
+    """Runs one pass of the real pipeline (modules.runner.process) against
+    the fake API.
+
+    Args:
+        args (Namespace): Benchmark options
+        home (Path): Temporary home folder
+
+    Returns:
+        dict: Benchmark results
+    """
+    # pylint: disable=import-outside-toplevel
+    from fakegmail import FIRST_HISTORY_ID, FakeGmail
+    from modules import runner
+    from modules.history import save_history_id
+    from modules.settings import get_settings
+
+    settings = get_settings()
+    gmail = FakeGmail(
+        message_count=args.messages,
+        attachment_size=args.size,
+        attachments=args.attachments,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    )
+    main = runner.Main(settings, settings.profiles()[0])
+    main.session = FakeSession(gmail)
+    main.service = gmail
+    main.set_index()
+    main.set_writer()
+    if args.history_sync:
+        # As if the last run synced the mailbox before any message came
+        save_history_id(main.profile.sync_state, str(FIRST_HISTORY_ID))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    # The pipeline's progress messages go to stderr, the results to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        runner.process(main, history_sync=args.history_sync)
+    elapsed = time.perf_counter() - started
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    tracemalloc.stop()
+    runner.close([main])
+
+    report = main.metrics.snapshot()
+    written = report["bytes written"] if "bytes written" in report else 0
+    return {
+        "options": {
+            key: value if not isinstance(value, Path) else str(value)
+            for key, value in vars(args).items()
+        },
+        "seconds": round(elapsed, 3),
+        "messages per second": round(len(main.processed) / elapsed, 1),
+        "megabytes per second": round(written / elapsed / 2**20, 2),
+        "completed": len(main.processed),
+        "failures": len(main.failures),
+        "archived": sum(
+            "INBOX" not in message["labelIds"] for message in gmail.mailbox.values()
+        ),
+        "response bytes": gmail.bytes_sent,
+        "peak heap bytes": heap_peak,
+        "peak rss bytes": peak_rss(),
+        "fake api calls": dict(sorted(gmail.calls.items())),
+        "metrics": report,
+    }
+
+
+def main(argv=None) -> int:
+    """Sets up an isolated home folder and runs the benchmark."""
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="pcreportsdl-bench-") as temp:
+        home = Path(temp)
+        # Settings paths are resolved from the home folder on import
+        os.environ["HOME"] = os.environ["USERPROFILE"] = temp
+        appfiles = home / "PyAppFiles" / "Papercut Reports Downloader"
+        appfiles.mkdir(parents=True)
+        config = json.loads((ROOT / "json" / "config.json").read_text("utf-8"))
+        config.update(
+            {
+                # The fake's sender, so history results pass the local check
+                "query": "label:INBOX from:papercut@example.org has:attachment",
+                "archive messages": True,
+                "page size": args.page_size,
+                "batch size": args.batch_size,
+                "download workers": args.workers,
+                "quota units per second": args.quota,
+                "field masks": not args.no_field_masks,
+                "pipeline": args.pipeline,
+                "pipeline queue size": args.queue_size,
+                "fsync": args.fsync,
+                "history sync": args.history_sync,
+            }
+        )
+        (appfiles / "config.json").write_text(json.dumps(config), "utf-8")
+        sys.path[:0] = [str(ROOT / "pcreportsdl"), str(ROOT / "benchmarks")]
+        results = run_pipeline(args, home)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    return 0 if not results["failures"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+
+Micro-benchmark of subject classification over a corpus of PaperCut
+style subjects: three separate regex searches per subject (as Message
+used to), and the combined classifier with and without its memo. The
+legacy school reports pattern is only timed on single near misses of
+growing length, on the corpus it would run for hours (printer group
+subjects such as "Printer Group Computer Labs - Summary" are near misses).
+Patterns known to backtrack catastrophically are also checked to be
+rejected by check_pattern.
+
+    python benchmarks/bench_subjects.py --subjects 5000
+
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "pcreportsdl"))
+
+# pylint: disable=wrong-import-position,protected-access
+from modules.classify import SubjectClassifier, _parse_date, check_pattern  # noqa: E402
+from modules.settings import DEFAULTS, LEGACY_PATTERNS  # noqa: E402
+
+SCHOOLS = (
+    "North Elementary",
+    "South Middle",
+    "East High",
+    "West Academy",
+    "Saint Mary Catholic School",
+    "Riverside Early Learning Center",
+)
+GROUPS = ("Library", "Admin Office", "Staff Room", "Computer Labs", "Students")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct")
+
+# Patterns that take exponential time on near misses, check_pattern has
+# to reject every one of them
+BACKTRACKING = (
+    r"(\s*[A-Za-z]+)+x",
+    r"(.*a)+b",
+    r"(.*?,)+x",
+    r"(a|aa)+b",
+    r"(a|a)*b",
+)
+
+
+def make_corpus(count: int, seed: int = 0) -> list:
+    """Generates report subjects, with the repeats a mailbox has.
+
+    Args:
+        count (int): Number of subjects
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: Subject lines
+    """
+    rand = random.Random(seed)
+    distinct = []
+    for month in MONTHS:
+        date = f"{month} 1, 2021"
+        for school in SCHOOLS:
+            distinct.append(f"Automated report: {school} Executive summary - {date}")
+            distinct.append(f"Fwd: Automated report: {school} Executive summary {date}")
+        for group in GROUPS:
+            distinct.append(f"Automated report: Printer Group {group} - Summary {date}")
+        distinct.append(f"Scheduled report could not be generated {date}")
+        distinct.append("Re: toner order for the library")
+    return [rand.choice(distinct) for _ in range(count)]
+
+
+def separate_searches(school: str, printer: str, report_date: str):
+    """Classifies the way Message did before the classifier: three
+    separate searches of each subject."""
+    school_re, printer_re, date_re = map(re.compile, (school, printer, report_date))
+
+    def classify(subject):
+        found = date_re.search(subject)
+        report_date = _parse_date(found[1]) if found else None
+        folder = f"{found[2]}-{found[3]}" if found else None
+        found = school_re.search(subject)
+        if found:
+            return report_date, folder, "executive summary", f"{found[2]}.pdf"
+        kind = "printer groups" if printer_re.search(subject) else None
+        return report_date, folder, kind, None
+
+    return classify
+
+
+def timed(classify, corpus: list) -> float:
+    """Seconds taken to classify every subject in the corpus."""
+    started = time.perf_counter()
+    for subject in corpus:
+        classify(subject)
+    return time.perf_counter() - started
+
+
+def main(argv=None) -> int:
+    """Runs the benchmark and prints the results as json."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--subjects", type=int, default=5000, help="corpus size")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    corpus = make_corpus(args.subjects, args.seed)
+    current = (
+        DEFAULTS["school reports"],
+        DEFAULTS["printer groups"],
+        DEFAULTS["report date"],
+    )
+    legacy = (next(iter(LEGACY_PATTERNS["school reports"])),) + current[1:]
+    classifier = SubjectClassifier(*current)
+
+    results = {
+        "subjects": len(corpus),
+        "distinct subjects": len(set(corpus)),
+        "seconds": {
+            "separate searches": timed(separate_searches(*current), corpus),
+            "classifier, no memo": timed(classifier._classify, corpus),
+            "classifier": timed(classifier.classify, corpus),
+        },
+    }
+    results["seconds"] = {
+        name: round(seconds, 4) for name, seconds in results["seconds"].items()
+    }
+    # Growth on one near miss as the school name gets longer
+    results["near miss seconds"] = {
+        letters: {
+            "legacy pattern": round(timed(separate_searches(*legacy), [subject]), 4),
+            "classifier": round(timed(classifier._classify, [subject]), 4),
+        }
+        for letters, subject in (
+            (letters, f"Automated report: {'Abcd' * (letters // 4)} usage Jan 1, 2021")
+            for letters in (8, 12, 16)
+        )
+    }
+    results["rejected patterns"] = {
+        pattern: check_pattern(pattern) is not None for pattern in BACKTRACKING
+    }
+    print(json.dumps(results, indent=2))
+    return 0 if all(results["rejected patterns"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
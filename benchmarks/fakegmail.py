@@ -0,0 +1,467 @@
+"""
+
+Local stand-in for the parts of the Gmail API this project uses
+(messages.list, messages.get, messages.attachments.get, messages.modify,
+messages.batchModify, history.list, getProfile and batch requests), with
+configurable message counts, attachment sizes, latency and error
+injection. Used by the benchmarks, no network or account needed.
+
+"""
+
+import base64
+import copy
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from email.utils import format_datetime
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# History ID of the empty mailbox, older IDs have expired
+FIRST_HISTORY_ID = 1000
+
+SUBJECTS = (
+    "Automated report: {school} Executive summary - {date}",
+    "Automated report: Printer Group {group} - Summary {date}",
+)
+SCHOOLS = ("North Elementary", "South Middle", "East High", "West Academy")
+MONTHS = (
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec",
+)  # fmt: skip
+GROUPS = ("Admin", "Library", "Labs", "Staff", "Students")
+EPOCH = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+RECEIVED = (
+    "from papercut.example.org (papercut.example.org. [192.0.2.10]) by"
+    " mx.google.com with ESMTPS id x1si123456qkl.1 for <reports@example.org>"
+    " (version=TLS1_3 cipher=TLS_AES_256_GCM_SHA384 bits=256/256);"
+    " Fri, 01 Jan 2021 00:00:00 -0800 (PST)"
+)
+DKIM = "v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.org; s=mail; b=" + "B" * 340
+
+
+def parse_fields(mask: str) -> dict:
+    """Parses a partial response field mask such as
+    "messages(id),nextPageToken" into a tree of field names (the a/b
+    path form isn't supported).
+
+    Args:
+        mask (str): Field mask
+
+    Returns:
+        dict: Field name -> sub-tree (None for the whole field)
+    """
+    tree, stack, name = {}, [], ""
+    node = tree
+    for char in mask + ",":
+        if char in ",()":
+            if name:
+                node[name] = {} if char == "(" else node.get(name)
+            if char == "(":
+                stack.append(node)
+                node = node[name]
+            elif char == ")":
+                node = stack.pop()
+            name = ""
+        else:
+            name += char.strip()
+    return tree
+
+
+def apply_fields(value, tree: dict):
+    """Keeps only the fields of a response that are in the mask tree."""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: apply_fields(value[key], sub)
+            for key, sub in tree.items()
+            if key in value
+        }
+    return value
+
+
+def query_matches(message: dict, query: str) -> bool:
+    """Checks a message against the terms of a search query the fake
+    understands: label:INBOX / in:inbox and after:/before: dates
+    (YYYY/MM/DD, against the message's internalDate). Other terms match
+    every message."""
+    sent = datetime.datetime.fromtimestamp(
+        int(message["internalDate"]) / 1000, datetime.timezone.utc
+    ).date()
+    for term in query.lower().split():
+        operator, _, value = term.partition(":")
+        if term in ("label:inbox", "in:inbox"):
+            found = "INBOX" in message["labelIds"]
+        elif operator in ("after", "before"):
+            day = datetime.datetime.strptime(value, "%Y/%m/%d").date()
+            found = sent >= day if operator == "after" else sent < day
+        else:
+            continue
+        if not found:
+            return False
+    return True
+
+
+def attachment_id(msg_id: str, index: int) -> str:
+    """Generates an attachment ID as long as Gmail's (a few hundred
+    characters, and sent in every attachment response)."""
+    return f"ANGjdJ{msg_id}{index:02d}" + "A" * 360
+
+
+def part_headers(mime_type: str, filename: str) -> list:
+    """Generates the MIME headers every message part has."""
+    headers = [{"name": "Content-Type", "value": f'{mime_type}; name="{filename}"'}]
+    if filename:
+        headers.append(
+            {
+                "name": "Content-Disposition",
+                "value": f'attachment; filename="{filename}"',
+            }
+        )
+    headers.append({"name": "Content-Transfer-Encoding", "value": "base64"})
+    return headers
+
+
+class FakeRequest:
+    """Request object with the execute() method the API client has."""
+
+    def __init__(self, gmail, method: str, handler) -> None:
+        self.gmail = gmail
+        self.method = method
+        self.handler = handler
+
+    def execute(self, num_retries: int = 0):
+        self.gmail.call(self.method)
+        return self.handler()
+
+
+class FakeBatch:
+    """Batch request: one round trip, with a response or an error for
+    each item."""
+
+    def __init__(self, gmail, callback=None) -> None:
+        self.gmail = gmail
+        self.callback = callback
+        self.items = []
+
+    def add(self, request, callback=None, request_id=None) -> None:
+        self.items.append((request, callback or self.callback, request_id))
+
+    def execute(self) -> None:
+        self.gmail.call("batch")
+        self.gmail.count("batch items", len(self.items))
+        for request, callback, request_id in self.items:
+            try:
+                self.gmail.inject_error()
+                response, error = request.handler(), None
+            except HttpError as err:
+                response, error = None, err
+            callback(request_id, response, error)
+
+
+class FakeGmail:
+    """Fake Gmail API service resource for a generated mailbox.
+
+    Args:
+        message_count (int): Report messages in the mailbox
+        attachment_size (int): Decoded size of each attachment in bytes
+        attachments (int): Attachments per message
+        latency (float): Seconds each round trip takes
+        error_rate (float): Fraction of calls failing with a 503
+        rate_limit_rate (float): Fraction of calls failing with a 429
+        duplicate_rate (float): Fraction of messages that are re-sent
+        copies of an earlier message
+        seed (int): Random seed, so runs are repeatable
+    """
+
+    def __init__(
+        self,
+        message_count: int = 200,
+        attachment_size: int = 200_000,
+        attachments: int = 1,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        duplicate_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.bytes_sent = 0
+        self.history_id = FIRST_HISTORY_ID
+        self.mailbox = {}
+        self.data = {}
+        for number in range(message_count):
+            if number and self.random.random() < duplicate_rate:
+                self.add_copy(number, self.random.randrange(number))
+            else:
+                self.add_message(number, attachment_size, attachments)
+
+    def add_message(self, number: int, attachment_size: int, attachments: int) -> str:
+        """Adds a generated report message to the mailbox.
+
+        Returns:
+            str: New message ID
+        """
+        msg_id = f"{number:016x}"
+        # Every message gets its own report date, so its own folder
+        date = f"{MONTHS[number % 12]} {number % 9 + 1}, {2000 + number // 36}"
+        subject = SUBJECTS[number % 2].format(
+            school=SCHOOLS[number % len(SCHOOLS)],
+            group=GROUPS[number % len(GROUPS)],
+            date=date,
+        )
+        parts = [
+            {
+                "partId": "0",
+                "mimeType": "text/plain",
+                "filename": "",
+                "headers": part_headers("text/plain", ""),
+                "body": {"size": 12, "data": "UmVwb3J0IGF0dGFjaGVk"},
+            }
+        ]
+        for index in range(attachments):
+            part_attachment_id = attachment_id(msg_id, index)
+            filename = f"report-{number}-{index}.pdf"
+            # Contents of their own, only re-sent copies are duplicates
+            block = hashlib.sha256(f"{number}.{index}".encode()).digest()
+            content = (block * (attachment_size // len(block) + 1))[:attachment_size]
+            self.data[part_attachment_id] = base64.urlsafe_b64encode(content).decode()
+            parts.append(
+                {
+                    "partId": str(index + 1),
+                    "mimeType": "application/pdf",
+                    "filename": filename,
+                    "headers": part_headers("application/pdf", filename),
+                    "body": {
+                        "size": attachment_size,
+                        "attachmentId": part_attachment_id,
+                    },
+                }
+            )
+        self.history_id += 1
+        sent = EPOCH + datetime.timedelta(hours=number)
+        self.mailbox[msg_id] = {
+            "id": msg_id,
+            "threadId": msg_id,
+            "historyId": str(self.history_id),
+            "labelIds": ["INBOX", "UNREAD"],
+            "snippet": "Report attached. This is an automated report from PaperCut MF.",
+            "sizeEstimate": attachment_size * attachments * 4 // 3 + 4000,
+            "internalDate": str(int(sent.timestamp() * 1000)),
+            "payload": {
+                "partId": "",
+                "mimeType": "multipart/mixed",
+                "filename": "",
+                "headers": [
+                    {"name": "Received", "value": RECEIVED},
+                    {"name": "Received", "value": RECEIVED},
+                    {"name": "DKIM-Signature", "value": DKIM},
+                    {"name": "Message-ID", "value": f"<{msg_id}@papercut.example.org>"},
+                    {"name": "MIME-Version", "value": "1.0"},
+                    {"name": "Date", "value": format_datetime(sent)},
+                    {"name": "From", "value": "papercut@example.org"},
+                    {"name": "To", "value": "reports@example.org"},
+                    {"name": "Subject", "value": subject},
+                    {"name": "Content-Type", "value": "multipart/mixed; boundary=x"},
+                ],
+                "body": {"size": 0},
+                "parts": parts,
+            },
+        }
+        return msg_id
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Adds to a call counter."""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + value
+
+    def add_copy(self, number: int, original: int) -> str:
+        """Adds a re-sent copy of an earlier message to the mailbox.
+
+        Returns:
+            str: New message ID
+        """
+        msg_id = f"{number:016x}"
+        message = copy.deepcopy(self.mailbox[f"{original:016x}"])
+        for index, part in enumerate(message["payload"]["parts"][1:]):
+            part_attachment_id = attachment_id(msg_id, index)
+            self.data[part_attachment_id] = self.data[part["body"]["attachmentId"]]
+            part["body"]["attachmentId"] = part_attachment_id
+        self.history_id += 1
+        message.update(id=msg_id, threadId=msg_id, historyId=str(self.history_id))
+        self.mailbox[msg_id] = message
+        return msg_id
+
+    def call(self, method: str) -> None:
+        """Counts a round trip, waits out the latency and injects errors."""
+        self.count(method)
+        if self.latency:
+            time.sleep(self.latency)
+        if method != "batch":
+            self.inject_error()
+
+    def inject_error(self) -> None:
+        """Raises a 503 or 429 HttpError at the configured rates."""
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            raise HttpError(
+                httplib2.Response({"status": 429, "retry-after": "0"}),
+                b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}',
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise HttpError(httplib2.Response({"status": 503}), b"Backend Error")
+
+    def _sent(self, response, fields: str = None):
+        """Applies the field mask and counts the response size."""
+        if fields:
+            response = apply_fields(response, parse_fields(fields))
+        size = len(json.dumps(response))
+        with self.lock:
+            self.bytes_sent += size
+        return response
+
+    # Resource chain: service.users().messages()... / service.users().history()
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId, fields=None):  # pylint: disable=invalid-name
+        profile = {
+            "emailAddress": "reports@example.org",
+            "messagesTotal": len(self.mailbox),
+            "historyId": str(self.history_id),
+        }
+        return FakeRequest(self, "getProfile", lambda: self._sent(profile, fields))
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+class _Messages:
+    def __init__(self, gmail: FakeGmail) -> None:
+        self.gmail = gmail
+
+    def list(self, userId, q="", maxResults=100, pageToken=None, fields=None):
+        def handler():
+            # Page tokens are cursors (the position in the mailbox after
+            # the last result), so archiving listed messages between pages
+            # doesn't shift the later pages
+            listed = list(self.gmail.mailbox.items())
+            ids = []
+            for position in range(int(pageToken or 0), len(listed)):
+                msg_id, message = listed[position]
+                if query_matches(message, q):
+                    ids.append(msg_id)
+                    if len(ids) == maxResults:
+                        break
+            page = {
+                "messages": [{"id": msg_id, "threadId": msg_id} for msg_id in ids],
+                "resultSizeEstimate": len(ids),
+            }
+            if ids and len(ids) == maxResults and position + 1 < len(listed):
+                page["nextPageToken"] = str(position + 1)
+            return self.gmail._sent(page, fields)
+
+        return FakeRequest(self.gmail, "messages.list", handler)
+
+    def get(self, userId, id, format="full", fields=None):
+        def handler():
+            if id not in self.gmail.mailbox:
+                raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+            return self.gmail._sent(self.gmail.mailbox[id], fields)
+
+        return FakeRequest(self.gmail, "messages.get", handler)
+
+    def attachments(self):
+        return _Attachments(self.gmail)
+
+    def modify(self, userId, id, body):
+        def handler():
+            self._remove_labels([id], body.get("removeLabelIds", []))
+            return self.gmail.mailbox[id]
+
+        return FakeRequest(self.gmail, "messages.modify", handler)
+
+    def batchModify(self, userId, body):  # pylint: disable=invalid-name
+        def handler():
+            self._remove_labels(body["ids"], body.get("removeLabelIds", []))
+            return ""
+
+        return FakeRequest(self.gmail, "messages.batchModify", handler)
+
+    def _remove_labels(self, ids, labels):
+        with self.gmail.lock:
+            for msg_id in ids:
+                message = self.gmail.mailbox[msg_id]
+                message["labelIds"] = [
+                    label for label in message["labelIds"] if label not in labels
+                ]
+
+
+class _Attachments:
+    def __init__(self, gmail: FakeGmail) -> None:
+        self.gmail = gmail
+
+    def get(self, userId, messageId, id, fields=None):
+        def handler():
+            data = self.gmail.data[id]
+            return self.gmail._sent(
+                {"attachmentId": id, "size": len(data) * 3 // 4, "data": data}, fields
+            )
+
+        return FakeRequest(self.gmail, "messages.attachments.get", handler)
+
+
+class _History:
+    def __init__(self, gmail: FakeGmail) -> None:
+        self.gmail = gmail
+
+    def list(
+        self,
+        userId,
+        startHistoryId,
+        historyTypes=None,
+        maxResults=100,
+        pageToken=None,
+        fields=None,
+    ):
+        def handler():
+            start_id = int(startHistoryId)
+            if start_id < FIRST_HISTORY_ID:
+                raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+            added = [
+                msg_id
+                for msg_id, message in self.gmail.mailbox.items()
+                if int(message["historyId"]) > start_id
+            ]
+            start = int(pageToken or 0)
+            page = {
+                "history": [
+                    {"messagesAdded": [{"message": {"id": msg_id, "threadId": msg_id}}]}
+                    for msg_id in added[start : start + maxResults]
+                ],
+                "historyId": str(self.gmail.history_id),
+            }
+            if start + maxResults < len(added):
+                page["nextPageToken"] = str(start + maxResults)
+            return self.gmail._sent(page, fields)
+
+        return FakeRequest(self.gmail, "history.list", handler)
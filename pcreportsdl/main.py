@@ -7,71 +7,110 @@ attachments sent by Papercut MF.
 
 __version__ = "2.0.0"
 
+import argparse
+import sys
 import time
-
-from tqdm import tqdm
+from datetime import datetime
 
 from modules import display
-from modules.findmsg import find_matching_messages
-from modules.message import Message
-from modules.output import write_msg_attachments
-from modules.screenclr import clearscreen
-from modules.service import get_service
-from modules.settings import TOKEN, CREDS, SCOPES, QUERY, ARCHIVE
-
-
-class Main:
-    def __init__(self):
-        self.service = None
-        self.matches = []
-        self.message_objects = []
-
-    def set_service(self):
-        """Gets Gmail API service"""
-        self.service = get_service(TOKEN, CREDS, SCOPES)
-
-    def set_matches(self) -> list:
-        """Get Messages matching the query"""
-        self.matches = find_matching_messages(self.service, QUERY)
-
-    def set_message_objects(self) -> list:
-        """Gets Message objects generated from matches"""
-        self.message_objects = [Message(self.service, match) for match in self.matches]
-
-
-def find_and_output_files(main) -> None:
-    """Finds matching messages and outputs the attached files"""
-    if not main.message_objects:
-        return
-    print(" Downloading message data.")
-    for message in tqdm(main.message_objects):
-        write_msg_attachments(main.service, message)
-
-
-def archive_messages(main) -> None:
-    """Marks messages as READ and removes them from the INBOX."""
-    if not main.message_objects:
-        return
-    print(" Archiving messages.")
-    for match in tqdm(main.matches):
-        # Mark message as read and archive (remove labels)
-        main.service.users().messages().modify(
-            userId="me",
-            id=match.get("id"),
-            body={"removeLabelIds": ["UNREAD", "INBOX"]},
-        ).execute()
-
-
-main = Main()
-display.ascii_art(__version__)
-print(" Connecting to Gmail API.")
-main.set_service()
-print(" Searching for matching messages.")
-main.set_matches()
-print(f" Matching messages found: {len(main.matches)}")
-main.set_message_objects()
-find_and_output_files(main)
-if ARCHIVE:
-    archive_messages(main)
-print(" Done.")
-time.sleep(2)
+from modules.settings import CONFIGJSON, create_config, get_settings
+
+
+def parse_day(value: str):
+    """Parses a YYYY-MM-DD command line date."""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a YYYY-MM-DD date") from err
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses the command line arguments.
+
+    Args:
+        argv (list, optional): Arguments to parse. Defaults to sys.argv.
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Download PaperCut reports from Gmail."
+    )
+    parser.add_argument(
+        "--rebuild-index",
+        action="store_true",
+        help="rebuild the download index by scanning the output folder, then exit",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and check for new messages until stopped",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last run from where it was interrupted",
+    )
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        type=parse_day,
+        metavar=("FROM", "TO"),
+        help="download the reports of every message from FROM to TO"
+        " (YYYY-MM-DD, both included), a month at a time in parallel",
+    )
+    parser.add_argument(
+        "--check-config",
+        action="store_true",
+        help="validate config.json and exit",
+    )
+    args = parser.parse_args(argv)
+    if args.backfill and (args.watch or args.rebuild_index):
+        parser.error("--backfill can't be used with --watch or --rebuild-index")
+    if args.backfill and args.backfill[0] > args.backfill[1]:
+        parser.error("--backfill FROM must not be after TO")
+    return args
+
+
+def main(argv=None) -> int:
+    """Runs the program.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+
+    Returns:
+        int: Exit status
+    """
+    args = parse_args(argv)
+    # First run from a terminal: write the default config and show where
+    if not args.check_config and not CONFIGJSON.exists() and sys.stdin.isatty():
+        create_config()
+    settings = get_settings()
+    problems = settings.validate()
+    if args.check_config or problems:
+        for problem in problems:
+            print(f" Config error: {problem}")
+        if not problems:
+            print(" Config OK.")
+        return 1 if problems else 0
+
+    # Deferred so --help and --check-config don't load the Google client
+    from modules.runner import backfill_run, run, watch
+
+    display.ascii_art(__version__)
+    if args.backfill:
+        backfill_run(*args.backfill, settings, resume=args.resume)
+        print(" Done.")
+        return 0
+    if args.watch and not args.rebuild_index:
+        watch(settings, resume=args.resume)
+        print(" Done.")
+        return 0
+    run(settings, rebuild_index_only=args.rebuild_index, resume=args.resume)
+    print(" Done.")
+    time.sleep(2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
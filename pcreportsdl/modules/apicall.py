@@ -0,0 +1,257 @@
+"""
+
+Shared layer for executing Gmail API requests. Keeps the run under the
+per-user quota with a token bucket that counts Gmail quota units, and
+retries rate limited and transient errors with exponential backoff.
+
+"""
+
+import contextvars
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+# Gmail quota units per method
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.attachments.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+}
+
+# Statuses worth retrying (rate limited or transient server errors)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class RateLimiter:
+    """Thread-safe token bucket counting Gmail quota units. The rate
+    adapts: it is halved whenever Gmail reports rate limiting, and grows
+    back towards max_rate as requests succeed."""
+
+    def __init__(self, max_rate: float = 250, min_rate: float = 10) -> None:
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.tokens = max_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units: float) -> float:
+        """Waits until the units are available and takes them.
+
+        Args:
+            units (float): Quota units needed
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        start = time.monotonic()
+        while True:
+            with self.lock:
+                self._refill()
+                # Requests larger than the bucket are let through when it
+                # is full, and leave it in debt: every unit is charged, so
+                # the next requests wait until the debt is paid off
+                needed = min(units, self.rate)
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return time.monotonic() - start
+                delay = (needed - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self) -> None:
+        """Halves the rate after Gmail reported rate limiting."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+
+    def succeeded(self) -> None:
+        """Grows the rate back after a successful request."""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class ApiStats:
+    """Thread-safe counters for the API calls made during a run."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.retries = 0
+        self.throttle_wait = 0.0
+        self.backoff_wait = 0.0
+        # Response times (seconds) of each method's calls
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def add(self, **counts) -> None:
+        """Adds to the named counters."""
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def record(self, method: str, seconds: float) -> None:
+        """Records the response time of a call.
+
+        Args:
+            method (str): Gmail method name
+            seconds (float): Time the call took
+        """
+        with self.lock:
+            self.latencies.setdefault(method, []).append(seconds)
+
+    def snapshot(self) -> dict:
+        """Gets the current counter values.
+
+        Returns:
+            dict: Counter values by name
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttle wait": round(self.throttle_wait, 3),
+                "backoff wait": round(self.backoff_wait, 3),
+                "methods": {
+                    method: {
+                        "calls": len(times),
+                        "p50": round(_percentile(times, 50), 4),
+                        "p95": round(_percentile(times, 95), 4),
+                    }
+                    for method, times in self.latencies.items()
+                },
+            }
+
+
+def _percentile(values: list, percent: float) -> float:
+    """Gets the nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+# Limiter and counters used by calls in the current context (each account
+# profile sets its own). Worker threads need to run in a copy of the
+# submitting thread's context to share them.
+_current = contextvars.ContextVar("apicall_current", default=None)
+_default = (RateLimiter(), ApiStats())
+
+
+def use(limiter: RateLimiter, stats: ApiStats) -> None:
+    """Sets the limiter and counters for calls made in the current context.
+
+    Args:
+        limiter (RateLimiter): Rate limiter to take quota units from
+        stats (ApiStats): Counters to add the calls to
+    """
+    _current.set((limiter, stats))
+
+
+def current_limiter() -> RateLimiter:
+    """Gets the current context's rate limiter."""
+    return (_current.get() or _default)[0]
+
+
+def current_stats() -> ApiStats:
+    """Gets the current context's counters."""
+    return (_current.get() or _default)[1]
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Checks whether the error is Gmail reporting rate limiting."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and any(
+        reason in str(error.content) for reason in RATE_LIMIT_REASONS
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """Checks whether a failed request is worth sending again.
+
+    Args:
+        error (Exception): Exception raised by the request
+
+    Returns:
+        bool: True for rate limiting, transient server and network errors
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRY_STATUSES or is_rate_limited(error)
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def retry_after(error: Exception) -> float:
+    """Gets the seconds a Retry-After header of the error asks to wait,
+    or 0 if it has none."""
+    if isinstance(error, HttpError):
+        value = error.resp.get("retry-after", "")
+        if value.isdigit():
+            return float(value)
+    return 0
+
+
+def backoff_delay(attempt: int, error: Exception = None, cap: float = 64) -> float:
+    """Generates the delay before retry number attempt (from 0): exponential
+    backoff with full jitter, but never shorter than a Retry-After header.
+
+    Args:
+        attempt (int): Number of retries already made
+        error (Exception, optional): Error being retried. Defaults to None.
+        cap (float, optional): Maximum backoff in seconds. Defaults to 64.
+
+    Returns:
+        float: Seconds to wait
+    """
+    return max(random.uniform(0, min(cap, 2**attempt)), retry_after(error))
+
+
+def execute(request, method: str, units: float = None, retries: int = 5):
+    """Executes a Gmail API request (or batch request) after taking its
+    quota units from the current limiter, retrying rate limited and
+    transient errors.
+
+    Args:
+        request (HttpRequest | BatchHttpRequest): Request to execute
+        method (str): Gmail method name, such as "messages.get"
+        units (float, optional): Quota units used (for batches). Defaults to
+        the method's units.
+        retries (int, optional): Maximum retries. Defaults to 5.
+
+    Returns:
+        any: The request's response
+    """
+    if units is None:
+        units = QUOTA_UNITS.get(method, 5)
+    limiter, stats = current_limiter(), current_stats()
+    for attempt in range(retries + 1):
+        stats.add(calls=1, throttle_wait=limiter.acquire(units))
+        start = time.monotonic()
+        try:
+            response = request.execute()
+        except Exception as err:  # pylint: disable=broad-except
+            stats.record(method, time.monotonic() - start)
+            if is_rate_limited(err):
+                limiter.throttled()
+            if attempt == retries or not is_retryable(err):
+                raise
+            delay = backoff_delay(attempt, err)
+            stats.add(retries=1, backoff_wait=delay)
+            time.sleep(delay)
+        else:
+            stats.record(method, time.monotonic() - start)
+            limiter.succeeded()
+            return response
@@ -0,0 +1,56 @@
+"""
+
+Marks messages as READ and removes them from the INBOX in bulk using
+Gmail's batchModify.
+
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from modules import apicall
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Gmail accepts up to 1000 message IDs per batchModify call
+MAX_CHUNK_SIZE = 1000
+
+
+def archive_messages(
+    service: Resource, message_ids: list, chunk_size: int = MAX_CHUNK_SIZE
+) -> list:
+    """Marks messages as READ and removes them from the INBOX, using one
+    batchModify call per chunk of message IDs.
+
+    Args:
+        service (Resource): Gmail API service
+        message_ids (list): IDs of the messages to archive
+        chunk_size (int, optional): IDs per call (max 1000). Defaults to
+        MAX_CHUNK_SIZE.
+
+    Returns:
+        list: (number of messages, exception or None) for each chunk. A
+        chunk that fails doesn't stop the others.
+    """
+    chunk_size = max(1, min(chunk_size, MAX_CHUNK_SIZE))
+    results = []
+    for start in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[start : start + chunk_size]
+        try:
+            apicall.execute(
+                service.users()
+                .messages()
+                .batchModify(
+                    userId="me",
+                    body={"ids": chunk, "removeLabelIds": ["UNREAD", "INBOX"]},
+                ),
+                "messages.batchModify",
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            results.append((len(chunk), err))
+        else:
+            results.append((len(chunk), None))
+
+    return results
@@ -0,0 +1,148 @@
+"""
+
+Fetches the details of matched messages using Gmail batch HTTP requests,
+so that a single round trip returns many messages instead of one.
+
+"""
+
+from __future__ import annotations
+
+from itertools import islice
+from time import sleep
+from typing import TYPE_CHECKING
+
+from tqdm import tqdm
+
+from modules import apicall, metrics
+from modules.message import Message
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+    from modules.classify import SubjectClassifier
+
+# Gmail accepts up to 100 calls in one batch request
+MAX_BATCH_SIZE = 100
+
+
+def _fetch_batch(
+    service: Resource,
+    matches: list,
+    fmt: str,
+    fields: str,
+    retries: int,
+    on_error=None,
+) -> list:
+    """Gets the details of one batch worth of matches, retrying only the
+    items that failed with a retryable error.
+
+    Args:
+        service (Resource): Gmail API service
+        matches (list): Matches (message resources) to fetch
+        fmt (str): Gmail message format (full, metadata, minimal)
+        fields (str): Partial response field mask, or None for everything
+        retries (int): Number of times failed items are requested again
+        on_error (callable, optional): Called with the ID and the error of
+        each message that couldn't be fetched. Defaults to printing them.
+
+    Returns:
+        list: Message details (dict), in the order of matches
+    """
+    results = {}
+    errors = {}
+    pending = [match["id"] for match in matches]
+    for attempt in range(retries + 1):
+        failed = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            else:
+                failed[request_id] = exception
+
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in pending:
+            batch.add(
+                service.users()
+                .messages()
+                .get(userId="me", id=msg_id, format=fmt, fields=fields),
+                request_id=msg_id,
+            )
+        with metrics.stage("metadata"):
+            apicall.execute(
+                batch,
+                "messages.get",
+                units=apicall.QUOTA_UNITS["messages.get"] * len(pending),
+            )
+
+        errors.update(failed)
+        pending = [
+            msg_id for msg_id, err in failed.items() if apicall.is_retryable(err)
+        ]
+        if any(apicall.is_rate_limited(err) for err in failed.values()):
+            apicall.current_limiter().throttled()
+        if not pending:
+            break
+        if attempt < retries:
+            # Wait as long as the longest Retry-After of the failed items
+            error = max((failed[msg_id] for msg_id in pending), key=apicall.retry_after)
+            delay = apicall.backoff_delay(attempt, error)
+            apicall.current_stats().add(retries=1, backoff_wait=delay)
+            sleep(delay)
+
+    for match in matches:
+        if match["id"] not in results:
+            err = errors.get(match["id"], "no response")
+            if on_error is None:
+                tqdm.write(f" Skipping message {match['id']}: {err}")
+            else:
+                on_error(match["id"], err)
+    return [results[match["id"]] for match in matches if match["id"] in results]
+
+
+def fetch_messages(
+    service: Resource,
+    matches,
+    classifier: SubjectClassifier,
+    batch_size: int = 50,
+    fmt: str = "full",
+    fields: str = None,
+    retries: int = 3,
+    on_fetch=None,
+    on_error=None,
+):
+    """Gets Message objects for the matches, requesting them from Gmail
+    in batches of batch_size. Messages are yielded as each batch returns,
+    so matches can be a generator that is still fetching results pages.
+
+    Args:
+        service (Resource): Gmail API service
+        matches (iterable): Matches (message resources) to fetch
+        classifier (SubjectClassifier): Classifier of the report details
+        in the subjects
+        batch_size (int, optional): Gets per batch request (max 100).
+        Defaults to 50.
+        fmt (str, optional): Gmail message format. Defaults to "full".
+        fields (str, optional): Partial response field mask. Defaults to None.
+        retries (int, optional): Retries for failed items. Defaults to 3.
+        on_fetch (callable, optional): Called with the details (dict) of
+        each fetched message, such as to journal them. Defaults to None.
+        on_error (callable, optional): Called with the ID and the error of
+        each message that couldn't be fetched, after its retries. Defaults
+        to printing them.
+
+    Yields:
+        Message: Message object for each match that was fetched
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    matches = iter(matches)
+    while True:
+        chunk = list(islice(matches, batch_size))
+        if not chunk:
+            break
+        for details in _fetch_batch(
+            service, chunk, fmt, fields, retries, on_error
+        ):
+            if on_fetch is not None:
+                on_fetch(details)
+            yield Message(details, classifier)
@@ -0,0 +1,318 @@
+"""
+
+Classifies report subjects: the configured report kind patterns are
+combined into one ordered pattern, so each subject is scanned once for
+its kind and once for its report date, and results are memoized by
+subject (PaperCut sends the same subjects over and over). Patterns are
+checked for nested quantifiers and overlapping repeated alternatives
+that backtrack catastrophically before they are used. The check reads
+the parsed pattern from the private re._parser (sre_parse before Python
+3.11), which may change between Python versions.
+
+"""
+
+import re
+import string
+from datetime import date, datetime
+from functools import lru_cache
+
+# Private module, there is no public API for the parsed pattern
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse  # pylint: disable=deprecated-module
+
+# Characters used to compare what parts of a pattern can match
+_PROBE = frozenset(string.printable + " é–")
+_REPEATS = ("MAX_REPEAT", "MIN_REPEAT")
+_ZERO_WIDTH = ("AT", "ASSERT", "ASSERT_NOT")
+_CATEGORIES = {
+    "CATEGORY_DIGIT": str.isdigit,
+    "CATEGORY_SPACE": str.isspace,
+    "CATEGORY_WORD": lambda char: char.isalnum() or char == "_",
+    "CATEGORY_LINEBREAK": lambda char: char == "\n",
+}
+
+
+class Classification:
+    """What a subject line says about its report."""
+
+    __slots__ = ("report_date", "folder_name", "report_kind", "output_name")
+
+    def __init__(self, report_date, folder_name, report_kind, output_name) -> None:
+        self.report_date = report_date
+        self.folder_name = folder_name
+        self.report_kind = report_kind
+        self.output_name = output_name
+
+
+def _category(name: str) -> frozenset:
+    """Probe characters in a character category (such as \\d or \\S)."""
+    negate = "_NOT_" in name
+    test = _CATEGORIES.get(name.replace("_NOT_", "_"), lambda char: False)
+    return frozenset(char for char in _PROBE if test(char) != negate)
+
+
+def _chars(op, arg) -> frozenset:
+    """Probe characters matched by a single-character item."""
+    op = str(op)
+    if op == "LITERAL":
+        return frozenset(chr(arg)) & _PROBE
+    if op == "NOT_LITERAL":
+        return _PROBE - {chr(arg)}
+    if op == "ANY":
+        return _PROBE - {"\n"}
+    if op == "CATEGORY":
+        return _category(str(arg))
+    if op == "RANGE":
+        return frozenset(char for char in _PROBE if arg[0] <= ord(char) <= arg[1])
+    if op == "IN":
+        chars = frozenset()
+        negate = False
+        for item_op, item_arg in arg:
+            if str(item_op) == "NEGATE":
+                negate = True
+            else:
+                chars |= _chars(item_op, item_arg)
+        return _PROBE - chars if negate else chars
+    return _PROBE
+
+
+def _nullable(seq) -> bool:
+    """Whether a parsed sequence can match the empty string."""
+    return all(_nullable_item(op, arg) for op, arg in seq)
+
+
+def _nullable_item(op, arg) -> bool:
+    op = str(op)
+    if op in _ZERO_WIDTH:
+        return True
+    if op in _REPEATS or op == "POSSESSIVE_REPEAT":
+        return arg[0] == 0 or _nullable(arg[2])
+    if op in ("SUBPATTERN", "ATOMIC_GROUP"):
+        return _nullable(arg[-1])
+    if op == "BRANCH":
+        return any(_nullable(branch) for branch in arg[1])
+    return False
+
+
+def _first(seq) -> frozenset:
+    """Probe characters a parsed sequence's match can start with."""
+    chars = frozenset()
+    for op, arg in seq:
+        chars |= _first_item(op, arg)
+        if not _nullable_item(op, arg):
+            break
+    return chars
+
+
+def _first_item(op, arg) -> frozenset:
+    name = str(op)
+    if name in _ZERO_WIDTH:
+        return frozenset()
+    if name in _REPEATS or name == "POSSESSIVE_REPEAT":
+        return _first(arg[2])
+    if name in ("SUBPATTERN", "ATOMIC_GROUP"):
+        return _first(arg[-1])
+    if name == "BRANCH":
+        return frozenset().union(*(_first(branch) for branch in arg[1]))
+    return _chars(op, arg)
+
+
+def _tail_repeats(seq) -> list:
+    """Unbounded backtracking repeats that can end a match of seq."""
+    tails = []
+    for op, arg in reversed(seq):
+        name = str(op)
+        if name in _REPEATS:
+            if arg[1] == sre_parse.MAXREPEAT:
+                tails.append(arg[2])
+            tails.extend(_tail_repeats(arg[2]))
+        elif name == "SUBPATTERN":
+            tails.extend(_tail_repeats(arg[-1]))
+        elif name == "BRANCH":
+            for branch in arg[1]:
+                tails.extend(_tail_repeats(branch))
+        if not _nullable_item(op, arg):
+            break
+    return tails
+
+
+def _overlapping_branch(seq, follow: list) -> bool:
+    """Looks for alternatives that can start the same way, counting what
+    follows them (follow after the end of seq), such as (a|aa)+. In a
+    repeated group, each way of choosing between them is tried in turn
+    before a match fails."""
+    seq = list(seq)
+    for index, (op, arg) in enumerate(seq):
+        name = str(op)
+        rest = seq[index + 1 :] + follow
+        if name == "BRANCH":
+            starts = [_first(list(branch) + rest) for branch in arg[1]]
+            for number, chars in enumerate(starts):
+                if any(chars & other for other in starts[number + 1 :]):
+                    return True
+            if any(_overlapping_branch(branch, rest) for branch in arg[1]):
+                return True
+        elif name in ("SUBPATTERN", "ATOMIC_GROUP"):
+            if _overlapping_branch(arg[-1], rest):
+                return True
+    return False
+
+
+def _overlapping_repeat(seq, follow: list) -> bool:
+    """Looks for an unbounded repeat that can match the characters that
+    follow it (follow after the end of seq), such as .* before the a in
+    (.*a)+. In a repeated group, every split of the text between the
+    repeat and what follows it is tried before a match fails."""
+    seq = list(seq)
+    for index, (op, arg) in enumerate(seq):
+        name = str(op)
+        rest = seq[index + 1 :] + follow
+        if name in _REPEATS:
+            if arg[1] == sre_parse.MAXREPEAT and _first(arg[2]) & _first(rest):
+                return True
+            if _overlapping_repeat(arg[2], rest):
+                return True
+        elif name in ("SUBPATTERN", "ATOMIC_GROUP"):
+            if _overlapping_repeat(arg[-1], rest):
+                return True
+        elif name == "BRANCH":
+            if any(_overlapping_repeat(branch, rest) for branch in arg[1]):
+                return True
+    return False
+
+
+def _find_nested(seq) -> bool:
+    """Looks for a repeated group whose body can end in a repeat that
+    could just as well continue into the group's next iteration, such as
+    (\\s*[A-Za-z]+)+, a repeat that overlaps what follows it, such as
+    (.*a)+, or alternatives that overlap, such as (a|aa)+. Every way of splitting the text between the two is tried before a
+    match fails, which takes exponential time."""
+    for op, arg in seq:
+        name = str(op)
+        if name in _REPEATS:
+            body = arg[2]
+            if arg[1] > 1 and (
+                any(_first(tail) & _first(body) for tail in _tail_repeats(body))
+                or _overlapping_repeat(body, list(body))
+                or _overlapping_branch(body, list(body))
+            ):
+                return True
+            if _find_nested(body):
+                return True
+        elif name in ("SUBPATTERN", "ATOMIC_GROUP", "POSSESSIVE_REPEAT"):
+            if _find_nested(arg[-1]):
+                return True
+        elif name == "BRANCH":
+            if any(_find_nested(branch) for branch in arg[1]):
+                return True
+        elif name in ("ASSERT", "ASSERT_NOT"):
+            if _find_nested(arg[1]):
+                return True
+    return False
+
+
+def check_pattern(pattern: str, groups: int = 0) -> str:
+    """Checks that a subject pattern compiles, can be combined with the
+    others, and won't backtrack catastrophically.
+
+    Args:
+        pattern (str): Regex pattern
+        groups (int, optional): Number of groups the pattern needs.
+        Defaults to 0.
+
+    Returns:
+        str: Description of the problem, or None if the pattern is usable
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, TypeError) as err:
+        return f"not a valid pattern ({err})"
+    state = getattr(parsed, "state", None) or parsed.pattern
+    if "GROUPREF" in str(list(parsed)) or state.groupdict:
+        return "using backreferences or named groups, which aren't supported"
+    if state.groups - 1 < groups:
+        return f"missing groups, {groups} are needed"
+    if _find_nested(list(parsed)):
+        return (
+            "using nested repeats or overlapping repeated alternatives that"
+            " backtrack catastrophically on subjects that don't match, such as"
+            " (\\s*[A-Za-z]+)+, (.*a)+ or (a|aa)+"
+        )
+    return None
+
+
+def _parse_date(text: str) -> date:
+    """Parses a report date such as 'Jan 1, 2021'.
+
+    Args:
+        text (str): Date text from the subject line
+
+    Returns:
+        date: Report date, or None if it isn't in the expected format
+    """
+    try:
+        return datetime.strptime(text, "%b %d, %Y").date()
+    except ValueError:
+        return None
+
+
+class SubjectClassifier:
+    """Finds the report date and kind of subject lines. The kind patterns
+    are combined into one, tried in order (executive summary, then
+    printer groups) at the first position where one of them matches.
+    Results are memoized by subject.
+
+    Args:
+        executive_sum (str): Pattern of school executive summary subjects,
+        group 2 is the output filename (without .pdf)
+        printer_grp (str): Pattern of printer group subjects
+        report_dt (str): Pattern of the report date, group 1 is the date,
+        groups 2 and 3 the month and year of the output folder
+
+    Raises:
+        ValueError: A pattern isn't usable (see check_pattern)
+    """
+
+    def __init__(
+        self,
+        executive_sum: str,
+        printer_grp: str,
+        report_dt: str,
+        cache_size: int = 4096,
+    ) -> None:
+        for pattern, groups in ((executive_sum, 2), (printer_grp, 0), (report_dt, 3)):
+            problem = check_pattern(pattern, groups)
+            if problem:
+                raise ValueError(f"Pattern {pattern!r} is {problem}")
+        self.kind_pattern = re.compile(
+            f"(?P<executive>{executive_sum})|(?P<printer>{printer_grp})"
+        )
+        self.date_pattern = re.compile(report_dt)
+        # Executive summary groups are numbered from its own group 0
+        self.executive_group = self.kind_pattern.groupindex["executive"]
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, subject: str) -> Classification:
+        """Classifies a subject line.
+
+        Args:
+            subject (str): Subject line
+
+        Returns:
+            Classification: Report date, folder, kind and output name
+        """
+        report_date = folder_name = report_kind = output_name = None
+        found = self.date_pattern.search(subject)
+        if found:
+            report_date = _parse_date(found[1])
+            folder_name = f"{found[2]}-{found[3]}"
+        found = self.kind_pattern.search(subject)
+        # School executive summaries are renamed after the school
+        if found and found["executive"] is not None:
+            report_kind = "executive summary"
+            output_name = f"{found[self.executive_group + 2]}.pdf"
+        elif found:
+            report_kind = "printer groups"
+        return Classification(report_date, folder_name, report_kind, output_name)
@@ -0,0 +1,69 @@
+"""
+
+Content-addressed deduplication of attachments. PaperCut sends the same
+report again for re-sent schedules, and forwarded copies of one report
+land in the mailbox more than once. Matching names and sizes don't make
+two reports the same, so a downloaded attachment is only hashed when an
+earlier file has its size, and only stored as a hardlink to that file
+when their content hashes match.
+
+"""
+
+import os
+import secrets
+from pathlib import Path
+
+from modules import metrics
+
+# Names tried for the link before giving up
+LINK_ATTEMPTS = 100
+
+
+def count_linked(size: int) -> None:
+    """Counts a duplicate attachment stored once in the run metrics.
+
+    Args:
+        size (int): Bytes saved
+    """
+    metrics.count("duplicates linked", 1)
+    metrics.count("bytes saved by dedup", size)
+
+
+def link_duplicate(file_path: Path, original: Path) -> bool:
+    """Makes file_path a hardlink to original (which has the same
+    contents), so the data is only stored once. The link is created next
+    to file_path under a unique name and renamed over it, so a file
+    already at file_path is never missing.
+
+    Args:
+        file_path (Path): Path of the duplicate, which may not exist yet
+        original (Path): Earlier file with the same contents
+
+    Returns:
+        bool: True if file_path is now a link to original, False if
+        linking isn't possible (such as across drives)
+    """
+    try:
+        if os.path.samefile(file_path, original):
+            return True
+    except OSError:
+        pass
+    for _ in range(LINK_ATTEMPTS):
+        temp_path = file_path.with_name(
+            f".{file_path.name}.{secrets.token_hex(4)}.link"
+        )
+        try:
+            os.link(original, temp_path)
+            break
+        except FileExistsError:
+            continue
+        except OSError:
+            return False
+    else:
+        return False
+    try:
+        os.replace(temp_path, file_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        return False
+    return True
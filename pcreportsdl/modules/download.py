@@ -0,0 +1,156 @@
+"""
+
+Downloads message attachments concurrently using a bounded pool of
+worker threads, each with its own Gmail service.
+
+"""
+
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from modules.output import ATTACHMENT_FIELDS, write_attachment
+from modules.settings import OUTFOLDER
+from modules.writer import Writer
+
+
+class DownloadResult:
+    """Outcome of a download run."""
+
+    def __init__(self) -> None:
+        # Messages with every attachment written
+        self.completed = []
+        # (message id, filename, exception) for each attachment that failed
+        self.failures = []
+
+
+def download_attachments(
+    service_factory,
+    messages,
+    workers: int = 4,
+    index=None,
+    outfolder: Path = OUTFOLDER,
+    desc: str = None,
+    dedup: bool = True,
+    journal=None,
+    fields: str = ATTACHMENT_FIELDS,
+    writer=None,
+) -> DownloadResult:
+    """Gets, decodes, and outputs the attachments of all messages using
+    a pool of worker threads. Messages are consumed as they arrive, so
+    downloads run while later messages are still being fetched. Each
+    attachment is recorded in the index and journal by its worker as
+    soon as it is written. Failed attachments are collected instead of
+    stopping the run.
+
+    Args:
+        service_factory (callable): Returns a Gmail API service for the
+        calling thread. Called once per worker thread (httplib2 is not
+        thread-safe).
+        messages (iterable): Message objects
+        workers (int, optional): Number of worker threads. Defaults to 4.
+        index (DownloadIndex, optional): Index of downloaded attachments.
+        Indexed attachments are skipped, and written ones are recorded.
+        Defaults to None.
+        outfolder (Path, optional): Output root folder. Defaults to OUTFOLDER.
+        desc (str, optional): Progress bar label. Defaults to None.
+        dedup (bool, optional): Store attachments with the same contents
+        as an indexed file once, as hardlinks, when no writer is given
+        (a writer deduplicates if it was given the index). Defaults to
+        True.
+        journal (Journal, optional): Checkpoint journal the written
+        attachments are recorded in. Defaults to None.
+        fields (str, optional): Partial response field mask of the
+        attachment downloads. Defaults to ATTACHMENT_FIELDS.
+        writer (Writer, optional): File writer the attachments are
+        written with. Defaults to None (a writer of their own, closed
+        when they are all written).
+
+    Returns:
+        DownloadResult: Completed messages and per-file failures
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    own_writer = writer is None
+    if own_writer:
+        writer = Writer(index=index if dedup else None)
+
+    def download(message_obj, part):
+        if not hasattr(local, "service"):
+            local.service = service_factory()
+        try:
+            outcome = write_attachment(
+                local.service, message_obj, part, writer, outfolder, fields
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            outcome = err
+        except BaseException as err:
+            # Such as SystemExit, raised from the calling thread below
+            stopped.append(err)
+            raise
+        finish(message_obj, part, outcome)
+
+    def complete(message_obj):
+        with lock:
+            result.completed.append(message_obj)
+        if index is not None:
+            index.mark_complete(message_obj.id)
+
+    def finish(message_obj, part, outcome):
+        # outcome is (file path, sha256), or the exception raised
+        msg_id = message_obj.id
+        failed = isinstance(outcome, Exception)
+        if not failed:
+            if index is not None:
+                index.add_attachment(msg_id, part.part_id, part.filename, *outcome)
+            if journal is not None:
+                journal.written(msg_id, part.part_id, outcome[0])
+        with lock:
+            if failed:
+                result.failures.append((msg_id, part.filename, outcome))
+                failed_ids.add(msg_id)
+            remaining[message_obj] -= 1
+            done = not remaining[message_obj] and msg_id not in failed_ids
+        if done:
+            complete(message_obj)
+
+    result = DownloadResult()
+    remaining = {}
+    failed_ids = set()
+    stopped = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, tqdm(
+            total=0, unit="file", desc=desc
+        ) as progress:
+            for message_obj in messages:
+                parts = message_obj.attachments
+                if index is not None:
+                    parts = [
+                        part
+                        for part in parts
+                        if not index.has_attachment(message_obj.id, part.part_id)
+                    ]
+                if not parts:
+                    complete(message_obj)
+                    continue
+                with lock:
+                    remaining[message_obj] = len(parts)
+                for part in parts:
+                    # Workers share the submitting context's API limiter
+                    future = pool.submit(
+                        contextvars.copy_context().run, download, message_obj, part
+                    )
+                    future.add_done_callback(lambda _: progress.update())
+                    progress.total += 1
+                progress.refresh()
+            # Leaving the pool waits for every download to be recorded
+    finally:
+        if own_writer:
+            writer.close()
+    if stopped:
+        raise stopped[0]
+
+    return result
@@ -1,33 +1,64 @@
 """
 
 Uses Gmail Services/API to search the user's mailbox for messages 
-matching the specified tags, and returns a list of the messages it finds and 
-prints the number found to the console.
+matching the specified tags, and yields the messages it finds one 
+results page at a time.
 
 """
 
+from __future__ import annotations
 
-from googleapiclient.discovery import Resource
+from typing import TYPE_CHECKING
 
+from modules import apicall
 
-def find_matching_messages(service: Resource, tags: str) -> list:
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Partial response of messages.list: only the IDs and the next page token
+LIST_FIELDS = "messages(id),nextPageToken"
+
+
+def find_matching_pages(
+    service: Resource,
+    tags: str,
+    page_size: int = 100,
+    page_token: str = None,
+    fields: str = LIST_FIELDS,
+):
     """Uses Gmail Services/API to search the user's mailbox for messages
-    matching the specified tags, and returns a list of the messages it finds.
+    matching the specified tags, and yields each results page as it
+    arrives, following nextPageToken until the last page.
 
     Args:
         service (Resource): Gmail services/API access resource
         tags (str): String of Gmail tags to search mailbox for matches of
+        page_size (int, optional): Results per page (maxResults, 1-500).
+        Defaults to 100.
+        page_token (str, optional): Token of the page to start from (to
+        continue an earlier search). Defaults to None, the first page.
+        fields (str, optional): Partial response field mask, or None for
+        everything. Defaults to LIST_FIELDS.
 
-    Returns:
-        list: List of messages matching the specified tags
+    Yields:
+        tuple: Message resources on the page (list), and the token of the
+        next page (str, None after the last page)
     """
+    while True:
+        page = apicall.execute(
+            service.users()
+            .messages()
+            .list(
+                userId="me",
+                q=tags,
+                maxResults=page_size,
+                pageToken=page_token,
+                fields=fields,
+            ),
+            "messages.list",
+        )
+        page_token = page.get("nextPageToken")
+        yield page.get("messages", []), page_token
 
-    matches = (
-        service.users()
-        .messages()
-        .list(userId="me", q=tags)
-        .execute()
-        .get("messages", [])
-    )
-
-    return matches
+        if not page_token:
+            break
@@ -0,0 +1,132 @@
+"""
+
+Uses the Gmail History API to find only the messages added to the
+mailbox since the last successful run, instead of re-running the
+whole search query.
+
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from googleapiclient.errors import HttpError
+
+from modules import apicall
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Partial responses: only the added message IDs and the next page token
+HISTORY_FIELDS = "history(messagesAdded(message(id))),nextPageToken"
+PROFILE_FIELDS = "historyId"
+
+
+class HistoryExpired(Exception):
+    """The stored history ID is too old (or invalid) for Gmail to return
+    the changes since then. A full search is needed instead."""
+
+
+def get_history_id(service: Resource, fields: str = PROFILE_FIELDS) -> str:
+    """Gets the mailbox's current history ID.
+
+    Args:
+        service (Resource): Gmail API service
+        fields (str, optional): Partial response field mask, or None for
+        everything. Defaults to PROFILE_FIELDS.
+
+    Returns:
+        str: Current history ID
+    """
+    profile = apicall.execute(
+        service.users().getProfile(userId="me", fields=fields), "getProfile"
+    )
+    return profile["historyId"]
+
+
+def load_history_id(state_file: Path) -> str:
+    """Loads the history ID stored by the last successful run.
+
+    Args:
+        state_file (Path): Sync state json file
+
+    Returns:
+        str: Stored history ID, or None if there isn't one
+    """
+    try:
+        with open(state_file, "r", encoding="utf-8") as json_file:
+            return json.load(json_file).get("history id")
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def save_history_id(state_file: Path, history_id: str) -> None:
+    """Stores the history ID for the next run.
+
+    Args:
+        state_file (Path): Sync state json file
+        history_id (str): History ID to store
+    """
+    Path(state_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(state_file, "w", encoding="utf-8") as json_file:
+        json.dump({"history id": history_id}, json_file, indent=2)
+
+
+def find_new_messages(
+    service: Resource,
+    start_history_id: str,
+    page_size: int = 100,
+    fields: str = HISTORY_FIELDS,
+):
+    """Walks the mailbox history since start_history_id and yields the
+    messages that were added, as each history page arrives. The messages
+    are not filtered by any query, so the caller needs to check them.
+
+    Args:
+        service (Resource): Gmail API service
+        start_history_id (str): History ID to list the changes since
+        page_size (int, optional): History records per page. Defaults to 100.
+        fields (str, optional): Partial response field mask, or None for
+        everything. Defaults to HISTORY_FIELDS.
+
+    Raises:
+        HistoryExpired: Gmail no longer has history for start_history_id
+
+    Yields:
+        dict: Message resource ({"id": ..., "threadId": ...}) added since
+        start_history_id
+    """
+    seen = set()
+    page_token = None
+    while True:
+        try:
+            page = apicall.execute(
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    maxResults=page_size,
+                    pageToken=page_token,
+                    fields=fields,
+                ),
+                "history.list",
+            )
+        except HttpError as err:
+            if err.resp.status == 404:
+                raise HistoryExpired(start_history_id) from err
+            raise
+
+        for record in page.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if message["id"] not in seen:
+                    seen.add(message["id"])
+                    yield {"id": message["id"], "threadId": message.get("threadId")}
+
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            break
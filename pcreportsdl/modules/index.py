@@ -0,0 +1,242 @@
+"""
+
+Local SQLite index of the messages and attachments that have already
+been downloaded, so later runs can skip them before making any Gmail
+API calls.
+
+"""
+
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+from modules.output import collision_path, output_path
+from modules.settings import OUTFOLDER
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    completed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    message_id TEXT NOT NULL,
+    part_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (message_id, part_id)
+);
+CREATE INDEX IF NOT EXISTS attachments_path ON attachments (path);
+CREATE INDEX IF NOT EXISTS attachments_content ON attachments (sha256, size);
+CREATE INDEX IF NOT EXISTS attachments_size ON attachments (size);
+"""
+
+
+def file_digest(file_path: Path) -> str:
+    """Generates the sha256 hex digest of a file's contents.
+
+    Args:
+        file_path (Path): File to hash
+
+    Returns:
+        str: sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _has_size(file_path: Path, size: int) -> bool:
+    """Checks that a file exists and has the expected size."""
+    try:
+        return file_path.stat().st_size == size
+    except OSError:
+        return False
+
+
+class DownloadIndex:
+    """Index of downloaded messages, keyed by message ID, and of their
+    attachments, keyed by message ID and part ID. (Gmail's attachmentId
+    changes between requests, so the part ID is used to identify an
+    attachment within its message.) The index can be used from several
+    threads, one statement at a time."""
+
+    def __init__(self, db_path: Path) -> None:
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        self.connection.close()
+
+    def is_complete(self, message_id: str) -> bool:
+        """Checks whether every attachment of the message was downloaded,
+        and their output files are all still present (so a message is
+        downloaded again after its files are lost).
+
+        Args:
+            message_id (str): Gmail message ID
+
+        Returns:
+            bool: True if the message is complete
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM messages WHERE message_id = ?", (message_id,)
+            ).fetchone()
+            files = self.connection.execute(
+                "SELECT path, size FROM attachments WHERE message_id = ?",
+                (message_id,),
+            ).fetchall()
+        return row is not None and all(
+            _has_size(Path(path), size) for path, size in files
+        )
+
+    def has_attachment(self, message_id: str, part_id: str) -> bool:
+        """Checks whether an attachment was downloaded and its output file
+        is still present.
+
+        Args:
+            message_id (str): Gmail message ID
+            part_id (str): Message part ID of the attachment
+
+        Returns:
+            bool: True if the attachment can be skipped
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, size FROM attachments"
+                " WHERE message_id = ? AND part_id = ?",
+                (message_id, part_id),
+            ).fetchone()
+        return row is not None and _has_size(Path(row[0]), row[1])
+
+    def has_content_size(self, size: int) -> bool:
+        """Checks whether any written file has the given size, the only
+        files another one of that size can be a duplicate of.
+
+        Args:
+            size (int): Size of the contents in bytes
+
+        Returns:
+            bool: True if a written file has that size
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM attachments WHERE size = ? LIMIT 1", (size,)
+            ).fetchone()
+        return row is not None
+
+    def find_content(self, sha256: str, size: int, exclude: Path) -> Path:
+        """Looks for a written file with the given contents, other than
+        exclude, that is still there.
+
+        Args:
+            sha256 (str): sha256 hex digest of the contents
+            size (int): Size of the contents in bytes
+            exclude (Path): File path to ignore (the new copy itself)
+
+        Returns:
+            Path: Path of a file with the same contents, or None
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT path FROM attachments"
+                " WHERE sha256 = ? AND size = ? AND path != ?",
+                (sha256, size, str(exclude)),
+            ).fetchall()
+        for (path,) in rows:
+            if _has_size(Path(path), size):
+                return Path(path)
+        return None
+
+    def add_attachment(
+        self, message_id: str, part_id: str, filename: str, path: Path, sha256: str
+    ) -> None:
+        """Records a written attachment.
+
+        Args:
+            message_id (str): Gmail message ID
+            part_id (str): Message part ID of the attachment
+            filename (str): Attachment filename from the message
+            path (Path): Output file path
+            sha256 (str): sha256 hex digest of the file contents
+        """
+        size = Path(path).stat().st_size
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?)",
+                (message_id, part_id, filename, str(path), size, sha256),
+            )
+
+    def mark_complete(self, message_id: str) -> None:
+        """Records that every attachment of the message was written.
+
+        Args:
+            message_id (str): Gmail message ID
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO messages (message_id) VALUES (?)",
+                (message_id,),
+            )
+
+    def clear(self) -> None:
+        """Removes every record from the index."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM attachments")
+            self.connection.execute("DELETE FROM messages")
+
+
+def rebuild_index(index: DownloadIndex, messages, outfolder: Path = OUTFOLDER) -> int:
+    """Rebuilds the index from the files already in the output folder.
+    Each message's attachments are located where they would be output
+    (or under their collision name), and the ones found are recorded
+    (hashing the file contents). Messages with every attachment present
+    are marked complete, and messages without an output path (no report
+    date in the subject) are skipped. Only message details are needed,
+    no attachments are downloaded.
+
+    Args:
+        index (DownloadIndex): Index to rebuild
+        messages (iterable): Message objects to look for
+        outfolder (Path, optional): Output root folder. Defaults to OUTFOLDER.
+
+    Returns:
+        int: Number of messages marked complete
+    """
+    index.clear()
+    complete = 0
+    for message_obj in messages:
+        found_all = True
+        for part in message_obj.attachments:
+            try:
+                file_path = output_path(message_obj, part, outfolder)
+            except ValueError:
+                found_all = False
+                break
+            renamed = collision_path(file_path, message_obj.id, part.part_id)
+            if renamed.is_file():
+                file_path = renamed
+            if not file_path.is_file():
+                found_all = False
+                continue
+            index.add_attachment(
+                message_obj.id,
+                part.part_id,
+                part.filename,
+                file_path,
+                file_digest(file_path),
+            )
+        if found_all:
+            index.mark_complete(message_obj.id)
+            complete += 1
+
+    return complete
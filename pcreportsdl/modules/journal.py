@@ -0,0 +1,177 @@
+"""
+
+Append-only checkpoint journal of a run, so an interrupted run (network
+drop, sign-in failure, the computer sleeping) can be resumed where it
+stopped instead of starting over. Each line is one json record of a
+completed step: a results page listed, a message's details fetched, an
+attachment written, messages archived, and finally the run finishing.
+
+"""
+
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+
+class ResumeState:
+    """Progress of an interrupted run, read back from the journal."""
+
+    def __init__(self) -> None:
+        self.history_id = None
+        # Listed message IDs, in the order they were listed
+        self.listed = {}
+        # Search query (or "history") -> {"next": page token, "finished": bool}
+        self.sources = {}
+        # Message ID -> message details from Gmail
+        self.fetched = {}
+        # (message ID, part ID) of each written attachment
+        self.written = set()
+        self.archived = set()
+
+    def apply(self, record: dict) -> None:
+        """Updates the state with one journal record."""
+        stage = record["stage"]
+        if stage == "start":
+            self.history_id = record.get("history id")
+        elif stage == "listed":
+            self.listed.update(dict.fromkeys(record["ids"]))
+            self.sources[record["source"]] = {
+                "next": record.get("next"),
+                "finished": record.get("finished", False),
+            }
+        elif stage == "fetched":
+            self.fetched[record["details"]["id"]] = record["details"]
+        elif stage == "written":
+            self.written.add((record["id"], record["part"]))
+        elif stage == "archived":
+            self.archived.update(record["ids"])
+
+
+class Journal:
+    """Checkpoint journal of one profile's runs. Only the latest run is
+    kept: beginning a run starts a new file. Records are only written
+    while a run is active, so other passes (such as rebuilding the index)
+    leave the journal alone."""
+
+    def __init__(self, file_path: Path) -> None:
+        self.file_path = Path(file_path)
+        self.file = None
+        # Pipeline stages write records from their own threads
+        self.lock = threading.Lock()
+
+    def begin(self, history_id: str = None) -> None:
+        """Starts the journal of a new run.
+
+        Args:
+            history_id (str, optional): Mailbox history ID at the start of
+            the run, stored by history sync when the run finishes.
+            Defaults to None.
+        """
+        self.close()
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.file_path, "w", encoding="utf-8")
+        self._write(
+            "start",
+            started=datetime.now().isoformat(timespec="seconds"),
+            **{"history id": history_id},
+        )
+
+    def resume(self) -> ResumeState:
+        """Reads back the progress of the last run and continues its
+        journal, if it didn't finish.
+
+        Returns:
+            ResumeState: Progress of the interrupted run, or None if the
+            last run finished (or there is no journal)
+        """
+        state = None
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # The last line may be cut short by the interruption
+                        continue
+                    if record["stage"] == "start":
+                        state = ResumeState()
+                    elif record["stage"] == "done":
+                        state = None
+                    if state is not None:
+                        state.apply(record)
+        except FileNotFoundError:
+            return None
+        if state is not None:
+            self.close()
+            self.file = open(self.file_path, "a", encoding="utf-8")
+            self._write("resumed", at=datetime.now().isoformat(timespec="seconds"))
+        return state
+
+    def finished(self) -> bool:
+        """Checks whether the last run in the journal finished.
+
+        Returns:
+            bool: True if the last run finished, False if it was
+            interrupted (or there is no journal)
+        """
+        last = None
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        last = json.loads(line)["stage"]
+                    except json.decoder.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            return False
+        return last == "done"
+
+    def _write(self, stage: str, **fields) -> None:
+        """Appends a record, flushed so it survives the process dying."""
+        line = json.dumps({"stage": stage, **fields}) + "\n"
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            self.file.flush()
+
+    def listed(
+        self, source: str, ids: list, next_token: str = None, finished: bool = False
+    ) -> None:
+        """Records listed messages.
+
+        Args:
+            source (str): Search query, or "history" for history sync
+            ids (list): IDs of the messages listed
+            next_token (str, optional): Token of the source's next results
+            page. Defaults to None.
+            finished (bool, optional): Whether the source has no more
+            results. Defaults to False.
+        """
+        self._write("listed", source=source, ids=ids, next=next_token, finished=finished)
+
+    def fetched(self, details: dict) -> None:
+        """Records a message's details as returned by Gmail."""
+        self._write("fetched", details=details)
+
+    def written(self, message_id: str, part_id: str, file_path: Path) -> None:
+        """Records an attachment written to its output file."""
+        self._write("written", id=message_id, part=part_id, path=str(file_path))
+
+    def archived(self, ids: list) -> None:
+        """Records archived messages."""
+        self._write("archived", ids=ids)
+
+    def done(self) -> None:
+        """Records that the run finished, so there is nothing to resume,
+        and stops journaling."""
+        self._write("done")
+        self.close()
+
+    def close(self) -> None:
+        """Closes the journal file (the run can still be resumed)."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
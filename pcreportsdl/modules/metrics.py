@@ -0,0 +1,189 @@
+"""
+
+Collects per-stage timings and byte counts for a run, and outputs them
+(with the API call counters) as a JSON run report and optionally as a
+Prometheus textfile.
+
+"""
+
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from modules.apicall import ApiStats
+
+
+class RunMetrics:
+    """Thread-safe timings and counters of one profile's run. Stage times
+    are summed over every thread that worked on the stage, so stages
+    worked on concurrently can add up to more than the wall time."""
+
+    def __init__(self, stats: ApiStats = None) -> None:
+        self.stats = stats or ApiStats()
+        self.started = datetime.now()
+        self.start = time.monotonic()
+        self.stage_seconds = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, stage_name: str, seconds: float) -> None:
+        """Adds time spent in a stage."""
+        with self.lock:
+            self.stage_seconds[stage_name] = (
+                self.stage_seconds.get(stage_name, 0.0) + seconds
+            )
+
+    def add(self, counter: str, value: int) -> None:
+        """Adds to a named counter (such as bytes written)."""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def snapshot(self) -> dict:
+        """Gets the current metrics.
+
+        Returns:
+            dict: Metrics, json compatible
+        """
+        with self.lock:
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "wall seconds": round(time.monotonic() - self.start, 3),
+                "stage seconds": {
+                    name: round(seconds, 3)
+                    for name, seconds in self.stage_seconds.items()
+                },
+                **self.counters,
+                "api": self.stats.snapshot(),
+            }
+
+
+# Metrics of the current context (each profile sets its own)
+_current = contextvars.ContextVar("metrics_current", default=None)
+
+
+def use(metrics: RunMetrics) -> None:
+    """Sets the metrics recorded to in the current context."""
+    _current.set(metrics)
+
+
+@contextmanager
+def stage(stage_name: str):
+    """Times the enclosed code as part of a stage of the current run."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add_time(stage_name, time.monotonic() - start)
+
+
+def timed(iterable, stage_name: str):
+    """Yields from iterable, timing the time spent getting each item as
+    part of a stage (for generators that make API calls)."""
+    iterator = iter(iterable)
+    while True:
+        with stage(stage_name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(counter: str, value: int) -> None:
+    """Adds to a named counter of the current run."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(counter, value)
+
+
+def _write_atomic(file_path: Path, text: str) -> None:
+    """Writes text to a temp file and renames it over file_path, so
+    readers never see a partial file."""
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=file_path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, file_path)
+
+
+def write_report(file_path: Path, profiles: dict) -> None:
+    """Outputs the run report json file.
+
+    Args:
+        file_path (Path): Report file path
+        profiles (dict): Metrics snapshot by profile name
+    """
+    _write_atomic(file_path, json.dumps({"profiles": profiles}, indent=2))
+
+
+def write_prometheus(file_path: Path, profiles: dict) -> None:
+    """Outputs the metrics in the Prometheus textfile format (for the
+    node_exporter textfile collector).
+
+    Args:
+        file_path (Path): Textfile path (should end in .prom)
+        profiles (dict): Metrics snapshot by profile name
+    """
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP pcreportsdl_{name} {help_text}")
+        lines.append(f"# TYPE pcreportsdl_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"pcreportsdl_{name}{{{label_text}}} {value}")
+
+    metric(
+        "wall_seconds",
+        "Wall time of the last run.",
+        [({"profile": name}, snap["wall seconds"]) for name, snap in profiles.items()],
+    )
+    metric(
+        "stage_seconds",
+        "Time spent in each stage, summed over threads.",
+        [
+            ({"profile": name, "stage": stage_name}, seconds)
+            for name, snap in profiles.items()
+            for stage_name, seconds in snap["stage seconds"].items()
+        ],
+    )
+    counters = sorted(
+        {key for snap in profiles.values() for key in snap if key.startswith("bytes")}
+    )
+    for counter in counters:
+        metric(
+            counter.replace(" ", "_"),
+            f"{counter.capitalize()} in the last run.",
+            [({"profile": name}, snap.get(counter, 0)) for name, snap in profiles.items()],
+        )
+    for key, name in (
+        ("calls", "api_calls"),
+        ("retries", "api_retries"),
+        ("throttle wait", "api_throttle_wait_seconds"),
+        ("backoff wait", "api_backoff_wait_seconds"),
+    ):
+        metric(
+            name,
+            f"API {key} in the last run.",
+            [({"profile": name}, snap["api"][key]) for name, snap in profiles.items()],
+        )
+    for quantile in ("p50", "p95"):
+        metric(
+            f"api_latency_{quantile}_seconds",
+            f"{quantile} API response time by method in the last run.",
+            [
+                ({"profile": name, "method": method}, values[quantile])
+                for name, snap in profiles.items()
+                for method, values in snap["api"]["methods"].items()
+            ],
+        )
+    _write_atomic(file_path, "\n".join(lines) + "\n")
@@ -0,0 +1,43 @@
+"""
+
+Walks a message's MIME part tree and finds its attachments at any depth
+(such as multipart/mixed -> multipart/alternative structures).
+
+"""
+
+
+class Attachment:
+    """Descriptor of one of a message's attachment parts. Small
+    attachments can come with their data inline, in which case data
+    holds the urlsafe base64 encoded contents and attachment_id may be
+    None."""
+
+    __slots__ = ("part_id", "filename", "mime_type", "size", "attachment_id", "data")
+
+    def __init__(self, part: dict) -> None:
+        body = part.get("body", {})
+        self.part_id = part["partId"]
+        self.filename = part["filename"]
+        self.mime_type = part.get("mimeType", "")
+        self.size = body.get("size", 0)
+        self.attachment_id = body.get("attachmentId")
+        self.data = body.get("data")
+
+
+def walk_attachments(payload: dict):
+    """Walks the MIME part tree of a message payload (without recursion)
+    and yields the attachments in document order.
+
+    Args:
+        payload (dict): Message payload from the Gmail API
+
+    Yields:
+        Attachment: Descriptor of each part with a filename
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("filename") and "partId" in part:
+            yield Attachment(part)
+        # Reversed so the first child is handled first
+        stack.extend(reversed(part.get("parts", [])))
@@ -4,48 +4,231 @@ Module containing functions for outputting message body and attachments.
 
 """
 
+from __future__ import annotations
+
 import base64
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
 
-from googleapiclient.discovery import Resource
+from modules import apicall, metrics
 from modules.settings import OUTFOLDER
 
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+    from modules.writer import Writer
+
+# Encoded characters decoded per chunk (a multiple of 4, 1 MiB decoded)
+CHUNK_SIZE = 4 * 256 * 1024
+
+# Partial response of attachments.get: only the data
+ATTACHMENT_FIELDS = "data"
+
+
+def output_path(message_obj, part, outfolder: Path = OUTFOLDER) -> Path:
+    """Generates the path the attachment is output to.
+
+    Args:
+        message_obj (Message): Message object
+        part (Attachment): Attachment descriptor
+        outfolder (Path, optional): Output root folder. Defaults to OUTFOLDER.
+
+    Raises:
+        ValueError: The subject line has no report date
+
+    Returns:
+        Path: Output file path
+    """
+    if not message_obj.folder_name:
+        raise ValueError(f"No report date in subject '{message_obj.subject}'")
+    # School executive summaries have their own output name
+    filename = message_obj.output_name or part.filename
+    return outfolder / message_obj.folder_name / filename
+
+
+def collision_path(file_path: Path, message_id: str, part_id: str) -> Path:
+    """Generates the path an attachment is output to instead of
+    file_path when a different file already has that name (such as the
+    executive summaries of two schools that share a name). The name is
+    made unique with the message and part IDs, so it is the same on
+    every run.
+
+    Args:
+        file_path (Path): Output file path that is taken
+        message_id (str): Gmail message ID
+        part_id (str): Message part ID of the attachment
+
+    Returns:
+        Path: Output file path for this attachment
+    """
+    return file_path.with_name(
+        f"{file_path.stem} ({message_id}.{part_id}){file_path.suffix}"
+    )
+
+
+def _decoded_chunks(encoded: str):
+    """Decodes urlsafe base64 data in fixed-size chunks, yielding each
+    decoded chunk."""
+    for start in range(0, len(encoded), CHUNK_SIZE):
+        chunk = encoded[start : start + CHUNK_SIZE]
+        # Gmail may leave off the padding on the last chunk
+        chunk += "=" * (-len(chunk) % 4)
+        with metrics.stage("decode"):
+            decoded = base64.urlsafe_b64decode(chunk)
+        yield decoded
+
+
+def decoded_size(encoded: str) -> int:
+    """Gets the size of urlsafe base64 data once decoded, without
+    decoding it.
+
+    Args:
+        encoded (str): urlsafe base64 encoded data
+
+    Returns:
+        int: Size of the decoded data in bytes
+    """
+    padding = len(encoded[-2:]) - len(encoded[-2:].rstrip("="))
+    return (len(encoded) - padding) * 3 // 4
+
+
+def decoded_digest(encoded: str) -> str:
+    """Generates the sha256 hex digest of urlsafe base64 data once
+    decoded, in fixed-size chunks, without writing it anywhere.
 
-def write_msg_attachments(service: Resource, message_obj) -> None:
-    """Gets, decodes, and outputs the message's attachments to the
+    Args:
+        encoded (str): urlsafe base64 encoded data
+
+    Returns:
+        str: sha256 hex digest of the decoded data
+    """
+    digest = hashlib.sha256()
+    for decoded in _decoded_chunks(encoded):
+        with metrics.stage("decode"):
+            digest.update(decoded)
+    return digest.hexdigest()
+
+
+def decode_to_temp(encoded: str, file_path: Path, sync: bool = False) -> tuple:
+    """Decodes urlsafe base64 data in fixed-size chunks straight into a
+    temporary file next to file_path. The whole decoded file is never
+    held in memory.
+
+    Args:
+        encoded (str): urlsafe base64 encoded data
+        file_path (Path): Output file path
+        sync (bool, optional): fsync the file before closing it.
+        Defaults to False.
+
+    Returns:
+        tuple: Temporary file path (Path) and sha256 hex digest of the
+        decoded data (str)
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(
+        dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".part"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for decoded in _decoded_chunks(encoded):
+                with metrics.stage("decode"):
+                    digest.update(decoded)
+                with metrics.stage("write"):
+                    f.write(decoded)
+                metrics.count("bytes written", len(decoded))
+            if sync:
+                with metrics.stage("fsync"):
+                    f.flush()
+                    os.fsync(f.fileno())
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+    return Path(temp_path), digest.hexdigest()
+
+
+def get_attachment_data(
+    service: Resource, message_obj, part, fields: str = ATTACHMENT_FIELDS
+) -> str:
+    """Gets one of the message's attachments, unless it came inline with
+    the message.
+
+    Args:
+        service (Resource): Gmail API service
+        message_obj (Message): Message object
+        part (Attachment): Attachment descriptor
+        fields (str, optional): Partial response field mask, or None for
+        everything. Defaults to ATTACHMENT_FIELDS.
+
+    Returns:
+        str: urlsafe base64 encoded attachment data
+    """
+    if part.data is not None:
+        return part.data
+    with metrics.stage("download"):
+        encoded = apicall.execute(
+            service.users()
+            .messages()
+            .attachments()
+            .get(
+                userId="me",
+                messageId=message_obj.id,
+                id=part.attachment_id,
+                fields=fields,
+            ),
+            "messages.attachments.get",
+        )
+    metrics.count("bytes downloaded", len(encoded["data"]))
+    return encoded.pop("data")
+
+
+def save_attachment(
+    encoded: str, message_obj, part, writer: Writer, outfolder: Path = OUTFOLDER
+) -> tuple:
+    """Decodes and outputs one of the message's attachments to the
     target folder.
 
+    Args:
+        encoded (str): urlsafe base64 encoded attachment data
+        message_obj (Message): Message object
+        part (Attachment): Attachment descriptor
+        writer (Writer): File writer to write with, which keeps files
+        with the same name apart
+        outfolder (Path, optional): Output root folder. Defaults to OUTFOLDER.
+
+    Returns:
+        tuple: Output file path (Path) and sha256 hex digest (str)
+    """
+    # Sets the ouptut folder
+    file_path = output_path(message_obj, part, outfolder)
+    return writer.write(encoded, file_path, message_obj.id, part.part_id)
+
+
+def write_attachment(
+    service: Resource,
+    message_obj,
+    part,
+    writer: Writer,
+    outfolder: Path = OUTFOLDER,
+    fields: str = ATTACHMENT_FIELDS,
+) -> tuple:
+    """Gets, decodes, and outputs one of the message's attachments to
+    the target folder.
+
     Args:
         service (Resource): Gmail API service
         message_obj (Message): Message object
+        part (Attachment): Attachment descriptor
+        writer (Writer): File writer to write with
+        outfolder (Path, optional): Output root folder. Defaults to OUTFOLDER.
+        fields (str, optional): Partial response field mask, or None for
+        everything. Defaults to ATTACHMENT_FIELDS.
+
+    Returns:
+        tuple: Output file path (Path) and sha256 hex digest (str)
     """
-    for each in message_obj.message_details["payload"]["parts"]:
-        if each["filename"] in message_obj.attachments_list:
-            pid = int(each["partId"])
-            # Gets encoded attachments
-            encoded = (
-                service.users()
-                .messages()
-                .attachments()
-                .get(
-                    userId="me",
-                    messageId=message_obj.message_details["id"],
-                    id=message_obj.message_details["payload"]["parts"][pid]["body"][
-                        "attachmentId"
-                    ],
-                )
-                .execute()
-            )
-            # Decodes the attachment data
-            decoded = base64.urlsafe_b64decode(encoded["data"].encode("UTF-8"))
-            # Sets the ouptut folder
-            output_folder = OUTFOLDER / message_obj.folder_name
-            if not output_folder.exists():
-                output_folder.mkdir(parents=True)
-            # Sets the filename for school executive summaries
-            if message_obj.executive_summary_prefix:
-                filename = f"{message_obj.executive_summary_prefix}.pdf"
-            else:
-                filename = each["filename"]
-            # Outputs decoded/named files
-            with open(output_folder / filename, "wb") as f:
-                f.write(decoded)
+    encoded = get_attachment_data(service, message_obj, part, fields)
+    return save_attachment(encoded, message_obj, part, writer, outfolder)
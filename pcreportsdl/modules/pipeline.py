@@ -0,0 +1,350 @@
+"""
+
+Runs one pass of the download pipeline as concurrent stages connected
+by bounded queues: search results feed the metadata fetch, fetched
+messages feed the attachment downloads, downloaded attachments feed the
+disk writer, and completed messages feed a batched archiver. A stage
+that gets ahead waits on the full queue in front of it, so memory stays
+flat however large the backlog is.
+
+"""
+
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+
+from tqdm import tqdm
+
+from modules import archive, metrics
+from modules.output import ATTACHMENT_FIELDS, get_attachment_data, output_path
+from modules.writer import Writer
+
+# Seconds a stage waits on a queue before checking whether another
+# stage failed
+POLL_INTERVAL = 0.5
+
+# Seconds a completed message waits for more to fill its archive batch
+ARCHIVE_WAIT = 10
+
+# Marks the end of a queue's items
+_DONE = object()
+
+
+class Cancelled(Exception):
+    """Stops a stage after another stage failed."""
+
+
+class Pipeline:
+    """The stages of one pass of a profile's pipeline. Every stage runs
+    in its own threads, with its own Gmail service, sharing the
+    profile's API limiter, metrics, index and journal. Results are
+    recorded on the Main like a sequential pass: processed messages,
+    known (already downloaded) IDs and failures."""
+
+    def __init__(
+        self,
+        main,
+        queue_size: int = 50,
+        archive_batch: int = archive.MAX_CHUNK_SIZE,
+    ) -> None:
+        self.main = main
+        self.settings = main.settings
+        self.queue_size = max(1, queue_size)
+        self.archive_batch = max(1, min(archive_batch, archive.MAX_CHUNK_SIZE))
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.errors = []
+        self.threads = []
+        self.progress = None
+        self.to_archive = None
+        # Attachments of each message still to be written, and the
+        # messages with an attachment that failed
+        self.remaining = {}
+        self.failed_ids = set()
+
+    def run(self) -> None:
+        """Runs every stage until the search results are all handled.
+
+        Raises:
+            Exception: The first error that stopped a stage
+        """
+        found = queue.Queue(self.queue_size)
+        fetched = queue.Queue(self.queue_size)
+        downloaded = queue.Queue(self.queue_size)
+        self.to_archive = queue.Queue(self.queue_size)
+        workers = max(1, self.settings.download_workers)
+        with tqdm(unit="file", desc=self.main.label.strip() or None) as progress:
+            self.progress = progress
+            self._start(self.search, found, then=lambda: self._close(found))
+            self._start(
+                self.fetch, found, fetched, then=lambda: self._close(fetched, workers)
+            )
+            self._start(
+                self.download,
+                fetched,
+                downloaded,
+                count=workers,
+                then=lambda: self._close(downloaded),
+            )
+            self._start(
+                self.write, downloaded, then=lambda: self._close(self.to_archive)
+            )
+            if self.main.archive:
+                self._start(self.archive, self.to_archive)
+            try:
+                for thread in self.threads:
+                    thread.join()
+            except BaseException:
+                self.failed.set()
+                raise
+        if self.errors:
+            raise self.errors[0]
+
+    def _start(self, target, *args, count: int = 1, then=None) -> None:
+        """Starts a stage: count threads running target(*args), in copies
+        of the current context. then() is called after the last of them
+        finishes. An error in any stage cancels the others."""
+        live = [count]
+
+        def run():
+            try:
+                target(*args)
+            except Cancelled:
+                pass
+            except BaseException as err:  # pylint: disable=broad-except
+                with self.lock:
+                    self.errors.append(err)
+                self.failed.set()
+            finally:
+                with self.lock:
+                    live[0] -= 1
+                    last = not live[0]
+                if last and then is not None:
+                    then()
+
+        for number in range(count):
+            thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(run,),
+                name=f"{target.__name__}-{number + 1}",
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def _put(self, items: queue.Queue, item) -> None:
+        """Adds an item to a queue, waiting while it is full."""
+        while not self.failed.is_set():
+            try:
+                items.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+        raise Cancelled
+
+    def _get(self, items: queue.Queue, wait: float = None):
+        """Takes the next item from a queue, waiting at most wait seconds
+        (None to wait as long as it takes).
+
+        Returns:
+            object: Next item, _DONE at the end of the queue, or None if
+            nothing arrived in time
+        """
+        deadline = None if wait is None else time.monotonic() + wait
+        while not self.failed.is_set():
+            timeout = POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return None
+            try:
+                return items.get(timeout=timeout)
+            except queue.Empty:
+                continue
+        raise Cancelled
+
+    def _items(self, items: queue.Queue):
+        """Yields a queue's items until its end."""
+        while True:
+            item = self._get(items)
+            if item is _DONE:
+                return
+            yield item
+
+    def _close(self, items: queue.Queue, consumers: int = 1) -> None:
+        """Marks the end of a queue for each of its consumers."""
+        try:
+            for _ in range(consumers):
+                self._put(items, _DONE)
+        except Cancelled:
+            pass
+
+    def _say(self, text: str) -> None:
+        """Prints a console message above the progress bar."""
+        tqdm.write(f" {self.main.label}{text}")
+
+    def search(self, found: queue.Queue) -> None:
+        """Search stage: lists the matching messages. Messages the index
+        already has downloaded go straight to the archiver."""
+        main = self.main
+        for match in main.matches:
+            if main.index.is_complete(match["id"]):
+                main.known_ids.append(match["id"])
+                self._archive(match["id"])
+            else:
+                self._put(found, match)
+
+    def fetch(self, found: queue.Queue, fetched: queue.Queue) -> None:
+        """Metadata stage: gets the details of the matches in batches."""
+        main = self.main
+        main.matches = self._items(found)
+        main.set_message_objects(main.session.service())
+        for message_obj in main.message_objects:
+            self._put(fetched, message_obj)
+
+    def download(self, fetched: queue.Queue, downloaded: queue.Queue) -> None:
+        """Download stage (one of several workers): gets the attachments
+        of each message that still have to be written."""
+        service = self.main.session.service()
+        fields = self.settings.fields(ATTACHMENT_FIELDS)
+        for message_obj in self._items(fetched):
+            for part in self._parts(message_obj):
+                try:
+                    encoded = get_attachment_data(service, message_obj, part, fields)
+                except Exception as err:  # pylint: disable=broad-except
+                    self._finish(message_obj, part, err)
+                    continue
+                # The queue holds the only copy of inline data
+                part.data = None
+                self._put(downloaded, (message_obj, part, encoded))
+
+    def write(self, downloaded: queue.Queue) -> None:
+        """Write stage: hands the downloaded attachments to the file
+        writer, and records them as they are written."""
+        main = self.main
+        writer = main.writer or Writer(
+            self.settings.fsync,
+            index=main.index if self.settings.deduplicate else None,
+        )
+        # Attachments handed to the writer, in order
+        pending = deque()
+        try:
+            for message_obj, part, encoded in self._items(downloaded):
+                try:
+                    file_path = output_path(message_obj, part, main.profile.outfolder)
+                except ValueError as err:
+                    self._finish(message_obj, part, err)
+                    continue
+                future = writer.submit(encoded, file_path, message_obj.id, part.part_id)
+                del encoded
+                pending.append((future, message_obj, part))
+                while pending and pending[0][0].done():
+                    self._written(*pending.popleft())
+        finally:
+            # The writer writes what it was given even when the pipeline
+            # is cancelled, record it so a resumed run doesn't download
+            # it again
+            while pending:
+                try:
+                    self._written(*pending.popleft())
+                except Cancelled:
+                    pass
+            if writer is not main.writer:
+                writer.close()
+
+    def _written(self, future, message_obj, part) -> None:
+        """Records an attachment the writer finished with."""
+        outcome = future.exception() or future.result()
+        self._finish(message_obj, part, outcome)
+
+    def archive(self, to_archive: queue.Queue) -> None:
+        """Archive stage: archives completed messages in batches. A batch
+        is sent when it is full, or ARCHIVE_WAIT seconds after its first
+        message if no more arrive."""
+        service = self.main.session.service()
+        batch = []
+        deadline = None
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            msg_id = self._get(to_archive, wait)
+            if msg_id is not None and msg_id is not _DONE:
+                batch.append(msg_id)
+                deadline = deadline or time.monotonic() + ARCHIVE_WAIT
+            if batch and (msg_id in (None, _DONE) or len(batch) >= self.archive_batch):
+                self._archive_batch(service, batch)
+                batch = []
+                deadline = None
+            if msg_id is _DONE:
+                return
+
+    def _archive_batch(self, service, message_ids: list) -> None:
+        """Archives a batch of messages, and journals it."""
+        with metrics.stage("archive"):
+            results = archive.archive_messages(service, message_ids)
+        start = 0
+        for count, err in results:
+            if err:
+                self._say(f"Failed to archive {count} messages: {err}")
+            else:
+                self.main.journal.archived(message_ids[start : start + count])
+                self._say(f"Archived {count} messages.")
+            start += count
+
+    def _parts(self, message_obj) -> list:
+        """Registers a message's attachments that still have to be
+        written, and gets them to download.
+
+        Returns:
+            list: Attachment descriptor for each download
+        """
+        main = self.main
+        parts = [
+            part
+            for part in message_obj.attachments
+            if not main.index.has_attachment(message_obj.id, part.part_id)
+        ]
+        if not parts:
+            self._complete(message_obj)
+            return []
+        with self.lock:
+            self.remaining[message_obj.id] = len(parts)
+        return parts
+
+    def _finish(self, message_obj, part, outcome) -> None:
+        """Records an attachment's outcome, (file path, sha256) or the
+        exception raised. Completes the message once all of its
+        attachments are written."""
+        main = self.main
+        msg_id = message_obj.id
+        failed = isinstance(outcome, BaseException)
+        if failed:
+            main.failures.append((msg_id, part.filename, outcome))
+        else:
+            main.index.add_attachment(msg_id, part.part_id, part.filename, *outcome)
+            main.journal.written(msg_id, part.part_id, outcome[0])
+        self.progress.update()
+        with self.lock:
+            if failed:
+                self.failed_ids.add(msg_id)
+            self.remaining[msg_id] -= 1
+            done = not self.remaining[msg_id]
+            if done:
+                del self.remaining[msg_id]
+                done = msg_id not in self.failed_ids
+                self.failed_ids.discard(msg_id)
+        if done:
+            self._complete(message_obj)
+
+    def _complete(self, message_obj) -> None:
+        """Records a message with every attachment written, and passes it
+        on to the archiver."""
+        self.main.processed.append(message_obj)
+        self.main.index.mark_complete(message_obj.id)
+        self._archive(message_obj.id)
+
+    def _archive(self, msg_id: str) -> None:
+        """Queues a message to be archived, unless it already was."""
+        if self.main.archive and msg_id not in self.main.archived_ids:
+            self._put(self.to_archive, msg_id)
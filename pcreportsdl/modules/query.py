@@ -0,0 +1,153 @@
+"""
+
+Builds the Gmail search queries, and checks messages against them
+locally for messages that were not found by running the query (such as
+History API results).
+
+"""
+
+import re
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Labels that Gmail stores by name (user labels are stored by ID)
+SYSTEM_LABELS = (
+    "INBOX",
+    "UNREAD",
+    "STARRED",
+    "IMPORTANT",
+    "SENT",
+    "DRAFT",
+    "SPAM",
+    "TRASH",
+)
+
+# A query term: a run of characters up to the next space, outside of
+# double quotes. Apostrophes are part of the term.
+QUERY_TERM = re.compile(r'(?:[^\s"]|"[^"]*")+')
+
+# Alternatives (OR, {...}) and groups ((...)) that can't be checked term
+# by term
+QUERY_GROUPING = re.compile(r"(^|\s)OR(\s|$)|[{}()]")
+
+
+def build_query(
+    query: str, after: date = None, before: date = None, has_attachment: bool = True
+) -> str:
+    """Adds the date range and has:attachment filters to a search query,
+    so Gmail leaves out the messages that would only be fetched to be
+    skipped here. Filters the query already has aren't added again.
+
+    Args:
+        query (str): Gmail search query
+        after (date, optional): Only messages from this day on. Defaults
+        to None.
+        before (date, optional): Only messages from before this day.
+        Defaults to None.
+        has_attachment (bool, optional): Only messages with attachments.
+        Defaults to True.
+
+    Returns:
+        str: Gmail search query with the filters
+    """
+    terms = [query.strip()] if query.strip() else []
+    if has_attachment and not re.search(r"(^|\s)has:attachment\b", query, re.I):
+        terms.append("has:attachment")
+    for operator, day in (("after", after), ("before", before)):
+        if day and not re.search(rf"(^|\s){operator}:", query, re.I):
+            terms.append(f"{operator}:{day:%Y/%m/%d}")
+    return " ".join(terms)
+
+
+def backfill_query(query: str, after: date, before: date) -> str:
+    """Builds the search query of a backfill: the query's mailbox state
+    terms (label:INBOX, in:inbox, label:UNREAD, is:unread) are removed,
+    as earlier reports were archived after downloading, and its date
+    terms are replaced with the backfill's date range.
+
+    Args:
+        query (str): Gmail search query
+        after (date): Only messages from this day on
+        before (date): Only messages from before this day
+
+    Returns:
+        str: Gmail search query for the date range
+    """
+    query = re.sub(
+        r"(^|\s)((label|in):(inbox|unread)|is:unread"
+        r"|-?(after|before|older_than|newer_than):\S+)(?=\s|$)",
+        " ",
+        query,
+        flags=re.I,
+    )
+    return build_query(" ".join(query.split()), after, before)
+
+
+def _query_date(value: str) -> date:
+    """Parses the date of an after:/before: term (YYYY/MM/DD or
+    YYYY-MM-DD), or None if it's in another format."""
+    try:
+        return datetime.strptime(value.replace("-", "/"), "%Y/%m/%d").date()
+    except ValueError:
+        return None
+
+
+def _message_date(message_obj) -> date:
+    """Gets the date a message was sent from its Date header, or None."""
+    try:
+        sent = parsedate_to_datetime(message_obj.headers["date"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if sent.tzinfo is not None:
+        sent = sent.astimezone(timezone.utc)
+    return sent.date()
+
+
+def matches_query(message_obj, query: str) -> bool:
+    """Checks the message against the terms of a Gmail search query that
+    can be evaluated from the message details: from:, to:, subject:,
+    label: (system labels like INBOX or UNREAD), has:attachment, and
+    after:/before: dates (compared with the Date header, to the day).
+    Negated terms (-term) and quoted values are supported. Other terms
+    can't be checked locally and are treated as matching, as are whole
+    queries with alternatives or groups (OR, {...}, (...)).
+
+    Args:
+        message_obj (Message): Message object
+        query (str): Gmail search query
+
+    Returns:
+        bool: False if any checkable term of the query doesn't match
+    """
+    if QUERY_GROUPING.search(query):
+        return True
+    headers = message_obj.headers
+    labels = {label.upper() for label in message_obj.label_ids}
+
+    for term in QUERY_TERM.findall(query):
+        negate = term.startswith("-")
+        term = term.lstrip("-")
+        operator, _, value = term.partition(":")
+        operator, value = operator.lower(), value.replace('"', "").lower()
+
+        if operator in ("from", "to", "subject"):
+            found = value in headers.get(operator, "").lower()
+        elif operator == "label" and value.upper() in SYSTEM_LABELS:
+            found = value.upper() in labels
+        elif operator == "has" and value == "attachment":
+            found = bool(message_obj.attachments)
+        elif operator in ("after", "before") and _query_date(value):
+            sent = _message_date(message_obj)
+            if sent is None:
+                continue
+            if operator == "after":
+                found = sent >= _query_date(value)
+            else:
+                found = sent < _query_date(value)
+        else:
+            continue
+
+        if found == negate:
+            return False
+
+    return True
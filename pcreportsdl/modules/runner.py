@@ -0,0 +1,721 @@
+"""
+
+Runs the download pipeline: searches for the matching messages, gets
+their details, downloads the attachments and optionally archives the
+messages. Importable without side effects, so it can be driven from
+other programs (such as a scheduler) as well as from main.py.
+
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import chain
+
+from tqdm import tqdm
+
+from modules import apicall, archive, metrics
+from modules.batchget import fetch_messages
+from modules.download import download_attachments
+from modules.findmsg import LIST_FIELDS, find_matching_pages
+from modules.history import (
+    HISTORY_FIELDS,
+    PROFILE_FIELDS,
+    HistoryExpired,
+    find_new_messages,
+    get_history_id,
+    load_history_id,
+    save_history_id,
+)
+from modules.index import DownloadIndex, rebuild_index
+from modules.journal import Journal
+from modules.message import Message
+from modules.output import ATTACHMENT_FIELDS
+from modules.pathcheck import check_paths
+from modules.pipeline import Pipeline
+from modules.query import backfill_query, matches_query
+from modules.service import get_session
+from modules.settings import DISCOVERYDOC, REPORTS, Profile, Settings, get_settings
+from modules.watch import AdaptiveInterval, Watcher
+from modules.writer import Writer
+
+
+class Main:
+    def __init__(self, settings: Settings, profile: Profile, label: str = ""):
+        self.settings = settings
+        self.profile = profile
+        # Prefix for console messages when several profiles run together
+        self.label = label
+        self.archive = settings.archive
+        # (after, before) dates searched instead of the configured range
+        self.search_range = None
+        self.limiter = apicall.RateLimiter(settings.quota_rate)
+        self.stats = apicall.ApiStats()
+        self.metrics = metrics.RunMetrics(self.stats)
+        self.error = None
+        self.session = None
+        self.index = None
+        self.writer = None
+        self.journal = Journal(profile.journal)
+        self.service = None
+        self.reset()
+
+    def reset(self) -> None:
+        """Clears the results of the last pass, keeping the service and
+        index for the next one"""
+        self.history_id = None
+        self.synced = False
+        # Details and archived IDs carried over from an interrupted run
+        self.fetched = {}
+        self.archived_ids = set()
+        self.matches = iter(())
+        self.message_objects = iter(())
+        self.processed = []
+        self.known_ids = []
+        self.failures = []
+
+    def say(self, text: str) -> None:
+        """Prints a console message, labelled with the profile name"""
+        print(f" {self.label}{text}")
+
+    def set_service(self):
+        """Gets Gmail API service"""
+        profile = self.profile
+        # Verify credentials file exists
+        check_paths(profile.creds)
+        self.session = get_session(
+            profile.token, profile.creds, self.settings.scopes, DISCOVERYDOC
+        )
+        self.service = self.session.service()
+
+    def set_index(self):
+        """Opens the local index of downloaded messages"""
+        self.index = DownloadIndex(self.profile.index_db)
+
+    def set_writer(self):
+        """Starts the file writer, which stores duplicates once with
+        deduplicate on"""
+        self.writer = Writer(
+            self.settings.fsync,
+            index=self.index if self.settings.deduplicate else None,
+        )
+
+    def shard(self, after: date, before: date, label: str) -> "Main":
+        """Creates the Main of one date range of a backfill. It shares
+        this Main's connection, index, rate limit and metrics, and has
+        its own journal. Backfilled messages aren't archived. The service
+        is set by the thread that runs the shard (httplib2 is not
+        thread-safe)."""
+        shard = Main(self.settings, self.profile, f"{self.label}{label} ")
+        shard.limiter = self.limiter
+        shard.stats = self.stats
+        shard.metrics = self.metrics
+        shard.session = self.session
+        shard.index = self.index
+        shard.writer = self.writer
+        shard.journal = Journal(
+            self.profile.backfill / f"{after:%Y-%m-%d}_{before:%Y-%m-%d}.jsonl"
+        )
+        shard.search_range = (after, before)
+        shard.archive = False
+        return shard
+
+    def queries(self) -> list:
+        """The profile's queries, with the date range and has:attachment
+        filters added"""
+        if self.search_range is not None:
+            return [
+                backfill_query(query, *self.search_range)
+                for query in self.profile.queries
+            ]
+        return [self.settings.search_query(query) for query in self.profile.queries]
+
+    def search(self, seen: set = None, sources: dict = None):
+        """Searches for each of the profile's queries in turn, yielding
+        every matching Message once. Each results page is journaled.
+        Queries an interrupted run finished (in sources) are skipped, and
+        unfinished ones continue from their next page"""
+        seen = set() if seen is None else seen
+        sources = sources or {}
+        for query in self.queries():
+            source = sources.get(query, {})
+            if source.get("finished"):
+                continue
+            pages = find_matching_pages(
+                self.service,
+                query,
+                self.settings.page_size,
+                source.get("next"),
+                self.settings.fields(LIST_FIELDS),
+            )
+            for page, next_token in metrics.timed(pages, "search"):
+                self.journal.listed(
+                    query, [match["id"] for match in page], next_token, not next_token
+                )
+                for match in page:
+                    if match["id"] not in seen:
+                        seen.add(match["id"])
+                        yield match
+
+    def search_history(self, start_history_id: str, seen: set = None):
+        """Lists the Messages added since start_history_id, journaling
+        each one. Falls back to the full search if the history expired"""
+        seen = set() if seen is None else seen
+        try:
+            for match in metrics.timed(
+                find_new_messages(
+                    self.service,
+                    start_history_id,
+                    self.settings.page_size,
+                    self.settings.fields(HISTORY_FIELDS),
+                ),
+                "search",
+            ):
+                self.journal.listed("history", [match["id"]])
+                if match["id"] not in seen:
+                    seen.add(match["id"])
+                    yield match
+            self.journal.listed("history", [], finished=True)
+        except HistoryExpired:
+            self.say("Stored history has expired, searching all messages.")
+            self.synced = False
+            yield from self.search(seen)
+
+    def set_matches(self) -> None:
+        """Starts the paged search for Messages matching the queries"""
+        self.matches = self.search()
+
+    def set_synced_matches(self) -> None:
+        """Starts listing the Messages added since the last successful run.
+        Uses the full search instead if there is no usable stored history."""
+        self.history_id = get_history_id(
+            self.service, self.settings.fields(PROFILE_FIELDS)
+        )
+        start_history_id = load_history_id(self.profile.sync_state)
+        if not start_history_id:
+            self.set_matches()
+            return
+
+        self.synced = True
+        self.matches = self.search_history(start_history_id)
+
+    def set_resumed_matches(self, state) -> None:
+        """Continues the listing of an interrupted run: the Messages it
+        already listed come first, then its unfinished searches continue
+        from where they stopped. Details it already fetched are reused."""
+        self.history_id = state.history_id
+        self.fetched = state.fetched
+        self.archived_ids = state.archived
+        self.synced = "history" in state.sources
+        self.say(
+            f"Resuming: {len(state.listed)} listed, {len(state.fetched)} fetched,"
+            f" {len(state.written)} files written, {len(state.archived)} archived."
+        )
+
+        def resumed():
+            seen = set(state.listed)
+            yield from ({"id": msg_id} for msg_id in state.listed)
+            history = state.sources.get("history")
+            if history is None:
+                yield from self.search(seen, state.sources)
+            elif not history["finished"]:
+                # History pages have no usable token, list them again
+                start_history_id = load_history_id(self.profile.sync_state)
+                yield from self.search_history(start_history_id, seen)
+
+        self.matches = resumed()
+
+    def skip_known_matches(self) -> None:
+        """Filters out matches the index already has downloaded, before
+        any of their details are requested"""
+        matches = self.matches
+
+        def unknown():
+            for match in matches:
+                if self.index.is_complete(match["id"]):
+                    self.known_ids.append(match["id"])
+                else:
+                    yield match
+
+        self.matches = unknown()
+
+    def set_message_objects(self, service=None) -> None:
+        """Gets Message objects generated from matches, fetched in batches
+        as each results page arrives. Details already fetched by an
+        interrupted run are used as they are, and new ones are journaled.
+        The fetches use service if given (such as from another thread),
+        or the Main's own service"""
+        ready = []
+        classifier = self.settings.subject_classifier
+
+        def unfetched():
+            for match in self.matches:
+                if match["id"] in self.fetched:
+                    ready.append(Message(self.fetched[match["id"]], classifier))
+                else:
+                    yield match
+
+        def drain():
+            while ready:
+                yield ready.pop(0)
+
+        fetched = fetch_messages(
+            service or self.service,
+            unfetched(),
+            classifier,
+            batch_size=self.settings.batch_size,
+            fmt=self.settings.message_format,
+            fields=self.settings.message_fields,
+            on_fetch=self.journal.fetched,
+            on_error=self.fetch_failed,
+        )
+        self.message_objects = chain(
+            (
+                message
+                for fetched_message in fetched
+                for message in chain(drain(), (fetched_message,))
+            ),
+            drain(),
+        )
+        # History results aren't filtered by the query, check them here
+        self.message_objects = (
+            message
+            for message in self.message_objects
+            if not self.synced
+            or (
+                any(matches_query(message, query) for query in self.queries())
+                and message.folder_name
+            )
+        )
+
+    def fetch_failed(self, msg_id: str, err: Exception) -> None:
+        """Records a message whose details couldn't be fetched as a
+        failure, so it is looked at again by the next run"""
+        self.failures.append((msg_id, None, err))
+        tqdm.write(f" {self.label}Failed to get message {msg_id}: {err}")
+
+    def save_sync_state(self) -> None:
+        """Stores the history ID from the start of the run, so the next
+        run only looks at messages added after it"""
+        if self.history_id and not self.failures:
+            save_history_id(self.profile.sync_state, self.history_id)
+
+
+def find_and_output_files(main) -> None:
+    """Finds matching messages and outputs the attached files"""
+    main.say("Downloading message data.")
+    result = download_attachments(
+        main.session.service,
+        main.message_objects,
+        workers=main.settings.download_workers,
+        index=main.index,
+        outfolder=main.profile.outfolder,
+        desc=main.label.strip() or None,
+        dedup=main.settings.deduplicate,
+        journal=main.journal,
+        fields=main.settings.fields(ATTACHMENT_FIELDS),
+        writer=main.writer,
+    )
+    main.processed = result.completed
+    main.failures.extend(result.failures)
+    say_download_failures(main)
+
+
+def pipeline_files(main) -> None:
+    """Finds matching messages, outputs the attached files and archives
+    the messages with every stage running at the same time"""
+    main.say("Downloading message data.")
+    Pipeline(main, main.settings.pipeline_queue_size).run()
+    say_download_failures(main)
+
+
+def say_download_failures(main) -> None:
+    """Lists the attachments that failed to download. Messages that
+    failed to fetch were already reported as they failed"""
+    for msg_id, filename, err in main.failures:
+        if filename is not None:
+            main.say(f"Failed to download '{filename}' from message {msg_id}: {err}")
+
+
+def archive_messages(main) -> None:
+    """Marks messages as READ and removes them from the INBOX. Only
+    messages with every attachment written are archived."""
+    message_ids = [
+        msg_id
+        for msg_id in [message.id for message in main.processed] + main.known_ids
+        if msg_id not in main.archived_ids
+    ]
+    if not message_ids:
+        return
+    main.say("Archiving messages.")
+    with metrics.stage("archive"):
+        results = archive.archive_messages(main.service, message_ids)
+    start = 0
+    for chunk, (count, err) in enumerate(results, start=1):
+        if err:
+            main.say(f"Chunk {chunk}: failed to archive {count} messages: {err}")
+        else:
+            main.journal.archived(message_ids[start : start + count])
+            main.say(f"Chunk {chunk}: archived {count} messages.")
+        start += count
+
+
+def rebuild(main) -> None:
+    """Rebuilds the download index from the files in the output folder."""
+    main.say("Rebuilding download index from the output folder.")
+    complete = rebuild_index(
+        main.index,
+        tqdm(main.message_objects, unit="msg"),
+        main.profile.outfolder,
+    )
+    main.say(f"Messages already downloaded: {complete}")
+
+
+def process(main, history_sync: bool = False, resume: bool = False) -> None:
+    """Runs one pass of the pipeline on a connected Main: searches for
+    matching messages, downloads their attachments and archives them.
+    Every completed step is journaled, and with resume an interrupted
+    pass is continued from its journal instead of starting over."""
+    apicall.use(main.limiter, main.stats)
+    metrics.use(main.metrics)
+    main.reset()
+    state = main.journal.resume() if resume else None
+    if resume and state is None:
+        main.say("No interrupted run to resume, starting a new one.")
+    main.say("Searching for matching messages.")
+    if state is not None:
+        main.set_resumed_matches(state)
+    else:
+        if history_sync:
+            main.set_synced_matches()
+        else:
+            main.set_matches()
+        main.journal.begin(main.history_id)
+    if main.settings.pipeline:
+        pipeline_files(main)
+    else:
+        main.skip_known_matches()
+        main.set_message_objects()
+        find_and_output_files(main)
+    main.say(f"Messages downloaded: {len(main.processed)}")
+    main.say(f"Messages skipped (already downloaded): {len(main.known_ids)}")
+    if main.archive and not main.settings.pipeline:
+        archive_messages(main)
+    main.save_sync_state()
+    main.journal.done()
+
+
+def month_shards(first: date, last: date) -> list:
+    """Splits the days from first to last (both included) into calendar
+    months, the same months as the output folders.
+
+    Args:
+        first (date): First day
+        last (date): Last day
+
+    Returns:
+        list: (after, before) dates of each month, before is the day
+        after the month's last day (as Gmail's before: excludes it)
+    """
+    shards = []
+    after = first
+    while after <= last:
+        next_month = (after.replace(day=1) + timedelta(days=32)).replace(day=1)
+        before = min(next_month, last + timedelta(days=1))
+        shards.append((after, before))
+        after = before
+    return shards
+
+
+def backfill(main, first: date, last: date, resume: bool = False) -> list:
+    """Downloads the reports of every message from first to last (both
+    included), on a connected Main. The range is split into months,
+    which are searched and downloaded at the same time ("backfill
+    shards" at once) within the profile's rate limit. Each month has its
+    own journal, so with resume the months an interrupted backfill
+    finished are skipped and the others continue where they stopped.
+    The results of all months are added up on main.
+
+    Args:
+        main (Main): Connected Main of the profile
+        first (date): First day
+        last (date): Last day
+        resume (bool, optional): Continue an interrupted backfill.
+        Defaults to False.
+
+    Returns:
+        list: Main of each month that was run
+    """
+    apicall.use(main.limiter, main.stats)
+    metrics.use(main.metrics)
+    main.reset()
+    shards = [
+        main.shard(after, before, f"[{after:%b-%Y}]")
+        for after, before in month_shards(first, last)
+    ]
+    if resume:
+        done = [shard for shard in shards if shard.journal.finished()]
+        if done:
+            main.say(f"Months finished by the interrupted backfill: {len(done)}")
+        shards = [shard for shard in shards if shard not in done]
+    main.say(f"Months to backfill from {first} to {last}: {len(shards)}")
+
+    def run_shard(shard):
+        try:
+            shard.service = shard.session.service()
+            process(shard, resume=resume and shard.journal.file_path.exists())
+        except Exception as err:  # pylint: disable=broad-except
+            shard.error = err
+            shard.say(f"Failed: {err}")
+        finally:
+            shard.journal.close()
+
+    workers = max(1, min(main.settings.backfill_shards, len(shards)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(
+            pool.map(
+                lambda shard: contextvars.copy_context().run(run_shard, shard),
+                shards,
+            )
+        )
+
+    for shard in shards:
+        main.processed.extend(shard.processed)
+        main.known_ids.extend(shard.known_ids)
+        main.failures.extend(shard.failures)
+    failed = [shard for shard in shards if shard.error]
+    if failed:
+        main.error = (
+            f"{len(failed)} of {len(shards)} months failed,"
+            " run again with --resume to retry them"
+        )
+    return shards
+
+
+def rebuild_only(main) -> None:
+    """Rebuilds a connected Main's download index."""
+    apicall.use(main.limiter, main.stats)
+    metrics.use(main.metrics)
+    main.say("Searching for matching messages.")
+    main.set_matches()
+    main.set_message_objects()
+    rebuild(main)
+
+
+def print_summary(mains: list) -> None:
+    """Prints the results and API call counters of each profile, and the
+    totals when there are several."""
+    totals = {"downloaded": 0, "skipped": 0, "failed": 0, "calls": 0, "retries": 0}
+    for main in mains:
+        api_stats = main.stats.snapshot()
+        counts = {
+            "downloaded": len(main.processed),
+            "skipped": len(main.known_ids),
+            "failed": len(main.failures),
+            "calls": api_stats["calls"],
+            "retries": api_stats["retries"],
+        }
+        for key, value in counts.items():
+            totals[key] += value
+        status = f" Error: {main.error}" if main.error else ""
+        main.say(
+            f"Downloaded: {counts['downloaded']}, skipped: {counts['skipped']},"
+            f" failed: {counts['failed']}, API calls: {counts['calls']},"
+            f" retries: {counts['retries']},"
+            f" throttled: {api_stats['throttle wait']}s.{status}"
+        )
+    if len(mains) > 1:
+        print(
+            f" All profiles - downloaded: {totals['downloaded']},"
+            f" skipped: {totals['skipped']}, failed: {totals['failed']},"
+            f" API calls: {totals['calls']}, retries: {totals['retries']}"
+        )
+
+
+def write_reports(mains: list, report_file) -> None:
+    """Outputs the metrics of every profile as a json run report, and as
+    a Prometheus textfile if one is configured."""
+    profiles = {main.profile.name: main.metrics.snapshot() for main in mains}
+    metrics.write_report(report_file, profiles)
+    textfile = mains[0].settings.prometheus_textfile
+    if textfile:
+        metrics.write_prometheus(textfile, profiles)
+
+
+def report_path(kind: str):
+    """Generates a run report path in the reports folder."""
+    return REPORTS / f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.json"
+
+
+def connect(settings: Settings = None) -> list:
+    """Connects each account profile to the Gmail API and opens its
+    download index. Profiles connect one at a time, so any sign-in
+    prompts don't overlap.
+
+    Args:
+        settings (Settings, optional): Settings to use. Defaults to the
+        settings loaded from config.json.
+
+    Returns:
+        list: Connected Main for each profile, ready for process()
+
+    Raises:
+        ValueError: The settings have problems (such as no config.json)
+    """
+    if settings is None:
+        settings = get_settings()
+    problems = settings.validate()
+    if problems:
+        raise ValueError(f"Config errors: {'; '.join(problems)}")
+    profiles = settings.profiles()
+    mains = []
+    for profile in profiles:
+        label = f"[{profile.name}] " if len(profiles) > 1 else ""
+        main = Main(settings, profile, label)
+        main.say("Connecting to Gmail API.")
+        main.set_service()
+        main.set_index()
+        main.set_writer()
+        mains.append(main)
+    return mains
+
+
+def run_profiles(mains: list, task) -> None:
+    """Runs task for every profile, in parallel when there are several.
+    A profile that fails is recorded on its Main without stopping the
+    others.
+
+    Args:
+        mains (list): Connected Main for each profile
+        task (callable): Called with each Main
+    """
+    if len(mains) == 1:
+        task(mains[0])
+        return
+
+    def guarded(main):
+        try:
+            task(main)
+        except Exception as err:  # pylint: disable=broad-except
+            main.error = err
+
+    with ThreadPoolExecutor(max_workers=len(mains)) as pool:
+        list(pool.map(guarded, mains))
+
+
+def close(mains: list) -> None:
+    """Stops each profile's file writer, and closes its download index
+    and journal."""
+    for main in mains:
+        if main.writer is not None:
+            main.writer.close()
+        main.index.close()
+        main.journal.close()
+
+
+def run(
+    settings: Settings = None, rebuild_index_only: bool = False, resume: bool = False
+) -> list:
+    """Runs the whole pipeline once for every account profile.
+
+    Args:
+        settings (Settings, optional): Settings to use. Defaults to the
+        settings loaded from config.json.
+        rebuild_index_only (bool, optional): Only rebuild the download
+        index from the output folder. Defaults to False.
+        resume (bool, optional): Continue each profile's interrupted run
+        from its journal. Defaults to False.
+
+    Returns:
+        list: Finished Main for each profile, with the processed messages
+        and failures
+    """
+    mains = connect(settings)
+    try:
+        if rebuild_index_only:
+            run_profiles(mains, rebuild_only)
+        else:
+            run_profiles(
+                mains,
+                lambda main: process(main, main.settings.history_sync, resume),
+            )
+    finally:
+        close(mains)
+    print_summary(mains)
+    write_reports(mains, report_path("run"))
+    return mains
+
+
+def backfill_run(
+    first: date, last: date, settings: Settings = None, resume: bool = False
+) -> list:
+    """Backfills the reports of a date range for every account profile.
+
+    Args:
+        first (date): First day
+        last (date): Last day
+        settings (Settings, optional): Settings to use. Defaults to the
+        settings loaded from config.json.
+        resume (bool, optional): Continue each profile's interrupted
+        backfill of the same range. Defaults to False.
+
+    Returns:
+        list: Finished Main for each profile, with the results of all of
+        its months
+    """
+    mains = connect(settings)
+    try:
+        run_profiles(mains, lambda main: backfill(main, first, last, resume))
+    finally:
+        close(mains)
+    print_summary(mains)
+    write_reports(mains, report_path("backfill"))
+    return mains
+
+
+def watch(settings: Settings = None, resume: bool = False) -> list:
+    """Keeps running the pipeline for every account profile, polling for
+    new messages on an adaptive interval, until SIGTERM/SIGINT. The
+    services, caches and indexes stay open between polls, and every poll
+    after the first only looks at messages added since the previous one
+    (history sync).
+
+    Args:
+        settings (Settings, optional): Settings to use. Defaults to the
+        settings loaded from config.json.
+        resume (bool, optional): Continue each profile's interrupted run
+        from its journal on the first poll. Defaults to False.
+
+    Returns:
+        list: Last poll's Main for each profile
+    """
+    mains = connect(settings)
+    settings = mains[0].settings
+    watcher = Watcher(
+        AdaptiveInterval(settings.watch_min_interval, settings.watch_max_interval)
+    )
+    watcher.install_signal_handlers()
+
+    def poll_profile(main):
+        try:
+            process(main, history_sync=True, resume=resume and main not in polled)
+            polled.add(main)
+        except Exception as err:  # pylint: disable=broad-except
+            # Keep watching, the next poll retries from the stored history
+            main.say(f"Check failed: {err}")
+
+    polled = set()
+    report_file = report_path("watch")
+
+    def poll() -> bool:
+        run_profiles(mains, poll_profile)
+        # Metrics add up over the whole watch, the report is rewritten
+        write_reports(mains, report_file)
+        return any(main.processed or main.failures for main in mains)
+
+    try:
+        watcher.run(poll)
+    finally:
+        close(mains)
+    print_summary(mains)
+    return mains
@@ -5,25 +5,37 @@ generate an access token for the Gmail services.
 
 """
 
+import datetime
+import json
 import pickle
+import threading
 from pathlib import Path
 from time import sleep
 
-from modules import display
-
-from googleapiclient.discovery import Resource, build
+import httplib2
 from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import Resource, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from modules import display, metrics
+
+DISCOVERY_URI = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+
+# Access tokens are refreshed this long before they expire
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
 
 
-def get_service(token_file, creds_json, scopes) -> Resource:
+def get_credentials(token_file, creds_json, scopes) -> Credentials:
     """Uses the credentials downloaded from Gmail's API to
     generate an access token for the Gmail services. If one
     exists, it uses that one, if not, it creates one and saves it.
 
     Returns:
-        Resource: Gmail services access token.
+        Credentials: Gmail services access token.
     """
     while True:
         if Path(token_file).exists():
@@ -49,4 +61,117 @@ def get_service(token_file, creds_json, scopes) -> Resource:
             Path(token_file).unlink()
             continue
 
-        return build("gmail", "v1", credentials=creds)
+        return creds
+
+
+def load_discovery_document(cache_file: Path) -> dict:
+    """Loads the Gmail API discovery document from the on-disk cache.
+    If it isn't cached yet, uses the copy bundled with the API client
+    (or downloads it) and caches it.
+
+    Args:
+        cache_file (Path): Discovery document cache file
+
+    Returns:
+        dict: Parsed discovery document
+    """
+    cache_file = Path(cache_file)
+    if cache_file.exists():
+        try:
+            with open(cache_file, "r", encoding="utf-8") as json_file:
+                return json.load(json_file)
+        except json.decoder.JSONDecodeError:
+            pass
+
+    content = get_static_doc("gmail", "v1")
+    if content is None:
+        _, content = httplib2.Http(timeout=60).request(DISCOVERY_URI)
+        content = content.decode("utf-8")
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file, "w", encoding="utf-8") as json_file:
+        json_file.write(content)
+    return json.loads(content)
+
+
+class _SessionHttp(AuthorizedHttp):
+    """Authorized HTTP transport that lets the session refresh the
+    shared access token before each request if it is about to expire,
+    and counts the bytes sent and received in the run metrics."""
+
+    def __init__(self, session, http) -> None:
+        super().__init__(session.credentials, http=http)
+        self.session = session
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.session.refresh_if_expiring()
+        response, content = super().request(
+            uri, method, body=body, headers=headers, **kwargs
+        )
+        metrics.count("bytes sent", len(body or ""))
+        metrics.count("bytes received", len(content or b""))
+        return response, content
+
+
+class Session:
+    """Gmail API session shared by the whole run. The discovery document
+    is parsed once and the access token is shared by every thread and
+    refreshed (once, under a lock) shortly before it expires. Each thread
+    gets one keep-alive HTTP connection pool and service that are reused
+    for all of its calls (httplib2 objects can't be shared between
+    threads)."""
+
+    def __init__(self, credentials: Credentials, discovery_doc: dict, token_file=None):
+        self.credentials = credentials
+        self.discovery_doc = discovery_doc
+        self.token_file = token_file
+        self.refresh_lock = threading.Lock()
+        self.local = threading.local()
+
+    def refresh_if_expiring(self) -> None:
+        """Refreshes the access token if it expires within REFRESH_MARGIN,
+        and saves the refreshed token."""
+        creds = self.credentials
+        if not creds.refresh_token or not self._expiring():
+            return
+        with self.refresh_lock:
+            # Another thread may have refreshed it while this one waited
+            if not self._expiring():
+                return
+            creds.refresh(Request())
+            if self.token_file:
+                with open(self.token_file, "wb") as token:
+                    pickle.dump(creds, token)
+
+    def _expiring(self) -> bool:
+        """Checks whether the access token expires within REFRESH_MARGIN."""
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return False
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return expiry - now < REFRESH_MARGIN
+
+    def service(self) -> Resource:
+        """Gets the calling thread's Gmail services resource, building it
+        the first time the thread asks.
+
+        Returns:
+            Resource: Gmail services resource.
+        """
+        service = getattr(self.local, "service", None)
+        if service is None:
+            http = _SessionHttp(self, httplib2.Http(timeout=120))
+            service = build_from_document(self.discovery_doc, http=http)
+            self.local.service = service
+        return service
+
+
+def get_session(token_file, creds_json, scopes, discovery_cache) -> Session:
+    """Loads the access token (generating one if needed) and the cached
+    discovery document, and starts a Gmail API session.
+
+    Returns:
+        Session: Gmail API session.
+    """
+    creds = get_credentials(token_file, creds_json, scopes)
+    return Session(creds, load_discovery_document(discovery_cache), token_file)
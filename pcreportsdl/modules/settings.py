@@ -1,15 +1,21 @@
 """
 
-Load (use defaults first if not found) json data from
-file, and use that data to generate a settings file for import.
+Load json data from file, and use that data to generate the settings.
+Nothing is loaded at import time: the config is read the first time
+get_settings() is called, and each regex is compiled the first time it
+is used. Reading the config has no side effects, the default config is
+only written by create_config() (on an interactive first run).
 
 """
 
-import re
+import json
+from datetime import date, datetime
+from functools import cached_property, lru_cache
 from pathlib import Path
 
+from modules.classify import SubjectClassifier, check_pattern
 from modules.loadjsondata import loadjson
-from modules.pathcheck import check_paths
+from modules.query import build_query
 
 
 # External file locations
@@ -17,6 +23,12 @@ APPFILES = Path().home() / "PyAppFiles" / "Papercut Reports Downloader"
 CONFIGJSON = APPFILES / "config.json"
 CREDS = APPFILES / "credentials.json"
 TOKEN = APPFILES / "token.pickle"
+INDEXDB = APPFILES / "index.sqlite3"
+SYNCSTATE = APPFILES / "sync_state.json"
+JOURNAL = APPFILES / "journal.jsonl"
+BACKFILL = APPFILES / "backfill"
+DISCOVERYDOC = APPFILES / "gmail-v1-discovery.json"
+REPORTS = APPFILES / "reports"
 
 # Output folder for downloaded files
 OUTFOLDER = Path().home() / "Downloads"
@@ -33,6 +45,13 @@ DEFAULTS = {
         "label:UNREAD from:papercut@UPDATE_ME.org has:attachment",
     ],
     "query": "label:INBOX from:papercut@UPDATE_ME.COM has:attachment",
+    "date range comments": [
+        "Optional dates (YYYY-MM-DD) limiting the search to messages from",
+        "'search after' on and before 'search before'. They are added to the",
+        "query (with has:attachment) so Gmail only returns those messages.",
+    ],
+    "search after": "",
+    "search before": "",
     "scopes comments": [
         "These are the access 'Scopes' that this application will",
         "have to the Gmail account. (Read and modify Messages)",
@@ -45,25 +64,462 @@ DEFAULTS = {
         "after the files are downloaded.",
     ],
     "archive messages": False,
+    "history sync comments": [
+        "true/false flag to only look at messages added since the last",
+        "successful run (using Gmail's history), instead of searching the",
+        "whole mailbox every time. New messages are checked against the",
+        "query locally. Falls back to a full search when needed.",
+    ],
+    "history sync": False,
+    "page size comments": [
+        "Number of matching messages requested from Gmail per results page.",
+        "Gmail allows 1-500. Every page is fetched, this only changes how",
+        "many messages are retrieved per request.",
+    ],
+    "page size": 100,
+    "batch size comments": [
+        "Number of messages requested together in one Gmail batch request.",
+        "Gmail allows up to 100, but recommends 50 or fewer.",
+    ],
+    "batch size": 50,
+    "download workers comments": [
+        "Number of attachments downloaded at the same time.",
+    ],
+    "download workers": 4,
+    "deduplicate comments": [
+        "Store attachments with identical contents (same sha256) once, as",
+        "hardlinks, without writing the copies. Only attachments with the",
+        "size of an earlier file are hashed to check. The bytes saved are in",
+        "the run report.",
+    ],
+    "deduplicate": True,
+    "pipeline comments": [
+        "true/false flag to run the search, message details, downloads, file",
+        "writing and archiving at the same time, each stage passing its",
+        "results on through a queue of at most 'pipeline queue size' items.",
+        "Memory use stays flat however many messages there are.",
+    ],
+    "pipeline": False,
+    "pipeline queue size": 50,
+    "fsync comments": [
+        "When written files are synced to disk: 'none' (left to the system,",
+        "fastest), 'file' (each file before it is recorded as written) or",
+        "'folder' (the files written together are synced at once, folder by",
+        "folder). Use 'file' or 'folder' for network drives that can drop",
+        "recent writes when they disconnect. A file is never replaced by a",
+        "different one with the same name, the new one is written as",
+        "'name (message id.part id).ext' instead.",
+    ],
+    "fsync": "none",
+    "backfill comments": [
+        "Number of months searched and downloaded at the same time when",
+        "running with --backfill FROM TO.",
+    ],
+    "backfill shards": 4,
+    "quota units comments": [
+        "Gmail API quota units used per second at most. Gmail allows 250",
+        "per user. Lower it if other tools share the account's quota.",
+    ],
+    "quota units per second": 250,
+    "message format comments": [
+        "Gmail format used when requesting message details. 'full' is",
+        "needed to see the attachment parts ('metadata' returns headers only).",
+        "The fields mask limits the response to the headers and the part",
+        "descriptors used to find attachments, down to 4 levels of nested",
+        "multipart parts (leave empty for everything).",
+    ],
+    "message format": "full",
+    "field masks comments": [
+        "true/false flag to ask Gmail for only the response fields that are",
+        "used (message fields above, IDs of listed messages and attachment",
+        "data). The bytes received are in the run report, for comparing.",
+    ],
+    "field masks": True,
+    "message fields": "id,labelIds,payload(headers(name,value),partId,filename,mimeType,body(attachmentId,size,data),parts(partId,filename,mimeType,body(attachmentId,size,data),parts(partId,filename,mimeType,body(attachmentId,size,data),parts(partId,filename,mimeType,body(attachmentId,size,data),parts(partId,filename,mimeType,body(attachmentId,size,data))))))",
+    "watch comments": [
+        "Seconds between checks for new messages when running with --watch.",
+        "Checks start at the minimum and back off towards the maximum",
+        "while no new messages arrive.",
+    ],
+    "watch min interval": 60,
+    "watch max interval": 900,
+    "prometheus comments": [
+        "Optional path of a Prometheus textfile (ending in .prom) to write",
+        "the run metrics to, for node_exporter's textfile collector. A json",
+        "run report is always written to the reports folder next to this file.",
+    ],
+    "prometheus textfile": "",
+    "profiles comments": [
+        "Optional list of account profiles, all run at the same time in one",
+        "process. Each needs a unique 'name' and can set 'token' and",
+        "'credentials' (file names in this folder, or full paths), 'queries'",
+        "(list of search queries) and 'output folder' (relative to Downloads,",
+        "or a full path). Leave empty to use the single account above.",
+        "Example: {\"name\": \"north\", \"token\": \"north.pickle\",",
+        "\"credentials\": \"north.json\", \"queries\": [\"from:papercut@north.org",
+        "has:attachment\"], \"output folder\": \"North\"}",
+    ],
+    "profiles": [],
     "regex patterns comments": [
         "These are the Regular Expression search patterns for the project.",
         "These won't change unless reporting format from Papercut does.",
+        "Nested repeats such as (\\s*[A-Za-z]+)+ aren't accepted, they can",
+        "take minutes on long subjects that don't match.",
     ],
-    "school reports": "(Automated report: )([A-Za-z]+(\\s*[A-Za-z]+)+ Executive summary)",
+    "school reports": "(Automated report: )([A-Za-z]+(?:\\s+[A-Za-z]+)* Executive summary)",
     "printer groups": "(Automated report: )(([A-Za-z]+\\s)+)-\\s+[A-Za-z]+",
     "report date": "(([A-Z][a-z]{2})\\s\\d,\\s(\\d{4}))",
 }
 
-# Load (or set defaults) settings json data
-config = loadjson(CONFIGJSON, default_data=DEFAULTS)
+# When written files are synced to disk (see modules.writer)
+FSYNC_POLICIES = ("none", "file", "folder")
+
+# Earlier default patterns and their replacements. The original school
+# reports pattern backtracks catastrophically on long subjects that
+# don't match. Its replacement finds the same school names.
+LEGACY_PATTERNS = {
+    "school reports": {
+        "(Automated report: )([A-Za-z]+(\\s*[A-Za-z]+)+ Executive summary)": (
+            DEFAULTS["school reports"]
+        ),
+    },
+}
+
+# Groups each subject pattern needs
+PATTERN_GROUPS = {"school reports": 2, "printer groups": 0, "report date": 3}
+
+# Expected type of each config value
+TYPES = {
+    "query": str,
+    "search after": str,
+    "search before": str,
+    "scopes": str,
+    "archive messages": bool,
+    "history sync": bool,
+    "page size": int,
+    "batch size": int,
+    "download workers": int,
+    "deduplicate": bool,
+    "pipeline": bool,
+    "pipeline queue size": int,
+    "fsync": str,
+    "backfill shards": int,
+    "quota units per second": (int, float),
+    "watch min interval": (int, float),
+    "watch max interval": (int, float),
+    "message format": str,
+    "field masks": bool,
+    "message fields": str,
+    "prometheus textfile": str,
+    "profiles": list,
+    "school reports": str,
+    "printer groups": str,
+    "report date": str,
+}
+
+# Lowest and highest allowed value of numeric config values (None for no
+# highest). Gmail returns at most 500 search results per page and accepts
+# at most 100 calls per batch request.
+RANGES = {
+    "page size": (1, 500),
+    "batch size": (1, 100),
+    "download workers": (1, None),
+    "pipeline queue size": (1, None),
+    "backfill shards": (1, None),
+    "quota units per second": (1, None),
+    "watch min interval": (1, None),
+    "watch max interval": (1, None),
+}
+
+
+class Profile:
+    """Account profile: the token, credentials, queries and output folder
+    of one mailbox, plus where its download index, sync state and run
+    journal are kept."""
+
+    def __init__(
+        self,
+        name: str,
+        token: Path,
+        creds: Path,
+        queries: list,
+        outfolder: Path,
+        state_folder: Path,
+    ) -> None:
+        self.name = name
+        self.token = token
+        self.creds = creds
+        self.queries = queries
+        self.outfolder = outfolder
+        self.index_db = state_folder / INDEXDB.name
+        self.sync_state = state_folder / SYNCSTATE.name
+        self.journal = state_folder / JOURNAL.name
+        self.backfill = state_folder / BACKFILL.name
+
+
+def _parse_day(value: str) -> date:
+    """Parses a YYYY-MM-DD config date, or None if it's empty."""
+    return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+def _check_range(value: float, low: float, high: float) -> str:
+    """Describes how a number is out of range, or None if it isn't."""
+    if value < low:
+        return f"must be at least {low}, not {value!r}"
+    if high is not None and value > high:
+        return f"must be at most {high}, not {value!r}"
+    return None
+
+
+def _resolve(value: str, base: Path) -> Path:
+    """Resolves a config path, relative paths are taken from base."""
+    path = Path(value).expanduser()
+    return path if path.is_absolute() else base / path
+
+
+class Settings:
+    """Settings generated from the config json data. Values missing from
+    the config use the defaults, and the regex patterns are compiled the
+    first time they are used."""
+
+    def __init__(self, config: dict, load_problem: str = None) -> None:
+        self.config = config
+        # Why config.json couldn't be read, if it couldn't
+        self.load_problem = load_problem
+
+    def _get(self, key: str):
+        """Gets a config value, or its default if it is missing."""
+        return self.config.get(key, DEFAULTS[key])
+
+    def _pattern(self, key: str) -> str:
+        """Gets a subject pattern, replacing a legacy default pattern
+        with its current version."""
+        pattern = self._get(key)
+        return LEGACY_PATTERNS.get(key, {}).get(pattern, pattern)
+
+    def validate(self) -> list:
+        """Checks the config for values of the wrong type or out of range,
+        and invalid regex patterns.
+
+        Returns:
+            list: Description of each problem found (empty if valid)
+        """
+        if self.load_problem:
+            return [self.load_problem]
+        if not isinstance(self.config, dict):
+            return ["config.json could not be loaded"]
+        problems = []
+        invalid = set()
+        for key, expected in TYPES.items():
+            value = self._get(key)
+            # bool is an int subclass, don't accept it for numbers
+            if not isinstance(value, expected) or (
+                expected is not bool and isinstance(value, bool)
+            ):
+                problems.append(f"'{key}' has an invalid value: {value!r}")
+                invalid.add(key)
+            elif key in RANGES:
+                problem = _check_range(value, *RANGES[key])
+                if problem:
+                    problems.append(f"'{key}' {problem}")
+                    invalid.add(key)
+        watch_keys = {"watch min interval", "watch max interval"}
+        if (
+            not watch_keys & invalid
+            and self.watch_min_interval > self.watch_max_interval
+        ):
+            problems.append("'watch min interval' is above 'watch max interval'")
+        for key in ("search after", "search before"):
+            try:
+                _parse_day(self._get(key))
+            except (ValueError, TypeError):
+                problems.append(f"'{key}' is not a YYYY-MM-DD date")
+        if self._get("fsync") not in FSYNC_POLICIES:
+            problems.append(f"'fsync' must be one of {', '.join(FSYNC_POLICIES)}")
+        for key, groups in PATTERN_GROUPS.items():
+            problem = check_pattern(self._pattern(key), groups)
+            if problem:
+                problems.append(f"'{key}' is {problem}")
+        profiles = self._get("profiles")
+        names = []
+        for entry in profiles if isinstance(profiles, list) else []:
+            if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+                problems.append(f"profile {entry!r} needs a 'name'")
+                continue
+            names.append(entry["name"])
+            if not isinstance(entry.get("queries", []), list):
+                problems.append(f"profile '{entry['name']}' 'queries' must be a list")
+        if len(names) != len(set(names)):
+            problems.append("profile names must be unique")
+        return problems
+
+    @property
+    def query(self) -> str:
+        """Gmail search query for the report messages."""
+        return self._get("query")
+
+    @property
+    def search_after(self) -> date:
+        """Only search messages from this day on (None for no limit)."""
+        return _parse_day(self._get("search after"))
+
+    @property
+    def search_before(self) -> date:
+        """Only search messages from before this day (None for no limit)."""
+        return _parse_day(self._get("search before"))
+
+    def search_query(self, query: str) -> str:
+        """Adds the date range and has:attachment filters to a query."""
+        return build_query(query, self.search_after, self.search_before)
+
+    @property
+    def scopes(self) -> list:
+        """Access scopes requested for the Gmail account."""
+        return [self._get("scopes")]
+
+    @property
+    def archive(self) -> bool:
+        """Whether messages are archived after downloading."""
+        return self._get("archive messages")
+
+    @property
+    def history_sync(self) -> bool:
+        """Whether only messages added since the last run are checked."""
+        return self._get("history sync")
+
+    @property
+    def page_size(self) -> int:
+        """Search results requested per page."""
+        return self._get("page size")
+
+    @property
+    def batch_size(self) -> int:
+        """Message gets per batch request."""
+        return self._get("batch size")
+
+    @property
+    def download_workers(self) -> int:
+        """Number of attachment download threads."""
+        return self._get("download workers")
+
+    @property
+    def deduplicate(self) -> bool:
+        """Whether duplicate attachments are stored once."""
+        return self._get("deduplicate")
+
+    @property
+    def pipeline(self) -> bool:
+        """Whether the pipeline stages run at the same time."""
+        return self._get("pipeline")
+
+    @property
+    def pipeline_queue_size(self) -> int:
+        """Items waiting between two pipeline stages at most."""
+        return self._get("pipeline queue size")
+
+    @property
+    def fsync(self) -> str:
+        """When written files are synced to disk."""
+        return self._get("fsync")
+
+    @property
+    def backfill_shards(self) -> int:
+        """Number of backfill months run at the same time."""
+        return self._get("backfill shards")
+
+    @property
+    def quota_rate(self) -> float:
+        """Gmail quota units used per second at most."""
+        return self._get("quota units per second")
+
+    @property
+    def watch_min_interval(self) -> float:
+        """Seconds between watch mode checks while messages are arriving."""
+        return self._get("watch min interval")
+
+    @property
+    def watch_max_interval(self) -> float:
+        """Longest wait between watch mode checks."""
+        return self._get("watch max interval")
+
+    @property
+    def message_format(self) -> str:
+        """Gmail format used for message details."""
+        return self._get("message format")
+
+    @property
+    def field_masks(self) -> bool:
+        """Whether API calls ask for partial responses."""
+        return self._get("field masks")
+
+    def fields(self, mask: str) -> str:
+        """Gets a call's fields mask, or None if field masks are off."""
+        return mask if self.field_masks else None
+
+    @property
+    def message_fields(self) -> str:
+        """Fields mask for message details (None for everything)."""
+        return self.fields(self._get("message fields") or None)
+
+    @property
+    def prometheus_textfile(self) -> Path:
+        """Prometheus textfile for the run metrics (None to skip it)."""
+        value = self._get("prometheus textfile")
+        return Path(value).expanduser() if value else None
+
+    def profiles(self) -> list:
+        """Generates the account profiles to run. Without a "profiles"
+        list, the single account from the top-level settings is used,
+        with the original file locations.
+
+        Returns:
+            list: Profile for each account
+        """
+        if not self._get("profiles"):
+            return [Profile("default", TOKEN, CREDS, [self.query], OUTFOLDER, APPFILES)]
+        return [
+            Profile(
+                entry["name"],
+                _resolve(entry.get("token", f"{entry['name']}.pickle"), APPFILES),
+                _resolve(entry.get("credentials", CREDS.name), APPFILES),
+                entry.get("queries", [self.query]),
+                _resolve(entry.get("output folder", ""), OUTFOLDER),
+                APPFILES / "profiles" / entry["name"],
+            )
+            for entry in self._get("profiles")
+        ]
+
+    @cached_property
+    def subject_classifier(self) -> SubjectClassifier:
+        """Classifier of report subjects, from the subject patterns."""
+        return SubjectClassifier(
+            self._pattern("school reports"),
+            self._pattern("printer groups"),
+            self._pattern("report date"),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Loads the settings json data the first time it is called, and
+    returns the same Settings after that. A missing or unreadable
+    config.json is reported by Settings.validate(), the defaults are
+    used until then.
+
+    Returns:
+        Settings: Settings loaded from config.json
+    """
+    try:
+        with open(CONFIGJSON, "r", encoding="utf-8") as json_file:
+            return Settings(json.load(json_file))
+    except FileNotFoundError:
+        return Settings({}, f"config.json not found at {CONFIGJSON}")
+    except (OSError, ValueError) as err:
+        return Settings({}, f"config.json could not be loaded ({err})")
 
-# Verify credentials file exists
-check_paths(CREDS)
 
-# Load additional config info from json data
-QUERY = config["query"]
-SCOPES = [config["scopes"]]
-EXECUTIVE_SUM_RE = re.compile(config["school reports"])
-PRINTER_GRP_RE = re.compile(config["printer groups"])
-REPORT_DT_RE = re.compile(config["report date"])
-ARCHIVE = config["archive messages"]
+def create_config() -> None:
+    """Writes the default config.json on the first run, shows the readme
+    and waits for the user to read where it was written."""
+    loadjson(CONFIGJSON, default_data=DEFAULTS)
+    get_settings.cache_clear()
@@ -0,0 +1,81 @@
+"""
+
+Keeps the program running and polls for new messages on an adaptive
+interval: polls often while reports are arriving and backs off while
+the mailbox is quiet.
+
+"""
+
+import signal
+import threading
+
+
+class AdaptiveInterval:
+    """Poll interval that resets to the minimum when something was found
+    and grows by factor (up to the maximum) each time nothing was."""
+
+    def __init__(self, minimum: float, maximum: float, factor: float = 2) -> None:
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.current = minimum
+
+    def next(self, found: bool) -> float:
+        """Gets the wait before the next poll.
+
+        Args:
+            found (bool): Whether the last poll found new messages
+
+        Returns:
+            float: Seconds to wait
+        """
+        if found:
+            self.current = self.minimum
+        else:
+            self.current = min(self.maximum, self.current * self.factor)
+        return self.current
+
+
+class Watcher:
+    """Runs poll repeatedly until stopped. SIGTERM and SIGINT stop the
+    watcher once the current poll has finished, and SIGUSR1 (where the
+    platform has it) wakes it to poll right away, so an external
+    notification listener can push new arrivals."""
+
+    def __init__(self, interval: AdaptiveInterval) -> None:
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+
+    def stop(self, *_) -> None:
+        """Stops the watcher after the current poll."""
+        self.stopping.set()
+        self.wake.set()
+
+    def notify(self, *_) -> None:
+        """Wakes the watcher to poll now."""
+        self.wake.set()
+
+    def install_signal_handlers(self) -> None:
+        """Handles SIGTERM/SIGINT (stop) and SIGUSR1 (poll now). Must be
+        called from the main thread."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.notify)
+
+    def run(self, poll) -> None:
+        """Calls poll until the watcher is stopped.
+
+        Args:
+            poll (callable): Runs one poll and returns True if it found
+            new messages.
+        """
+        while not self.stopping.is_set():
+            found = poll()
+            if self.stopping.is_set():
+                break
+            wait = self.interval.next(found)
+            print(f" Next check in {wait:.0f} seconds.")
+            self.wake.wait(wait)
+            self.wake.clear()
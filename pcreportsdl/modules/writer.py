@@ -0,0 +1,246 @@
+"""
+
+Writes attachment files from one background thread, for output folders
+where every file system call is a round trip (such as SMB home folders).
+Folders are created once and remembered, waiting files are written in
+batches, files are synced to disk according to the fsync policy, a file
+is never silently replaced by a different one with the same name, and a
+file with the same contents as an indexed one is stored as a hardlink
+to it instead of being written again.
+
+"""
+
+import contextvars
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+from modules import metrics
+from modules.dedup import count_linked, link_duplicate
+from modules.index import file_digest
+from modules.output import (
+    collision_path,
+    decode_to_temp,
+    decoded_digest,
+    decoded_size,
+)
+from modules.settings import FSYNC_POLICIES
+
+# Files written at most between two syncs of the "folder" policy
+MAX_BATCH = 64
+
+
+def _sync_path(path: Path) -> None:
+    """fsyncs a file, or a folder's entries. Folders can't be synced on
+    Windows, where renames are already durable, so errors are ignored."""
+    try:
+        fd = os.open(path, os.O_RDONLY if path.is_dir() else os.O_RDWR)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Writer:
+    """Background file writer. Writes are submitted from any thread and
+    done in order by the writer's own thread, so deciding whether a name
+    is taken never races with another write.
+
+    fsync policies:
+        none: syncing is left to the system (fastest)
+        file: each file and its folder entry are synced before the file
+        is reported written
+        folder: the files of each batch are synced together, one folder
+        at a time, before they are reported written
+
+    With an index, duplicates are stored once: the contents of a file
+    with the same size as an indexed (or just written) file are hashed
+    before anything is written, and if that file has the same hash, the
+    new one is linked to it instead.
+    """
+
+    def __init__(self, fsync: str = "none", queue_size: int = 64, index=None) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}'")
+        self.fsync = fsync
+        self.index = index
+        # Files written by this writer, which may not be indexed yet:
+        # {size: {sha256: path}}
+        self.written = {}
+        self.jobs = queue.Queue(max(1, queue_size))
+        # Folders known to exist
+        self.created = set()
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def submit(
+        self, encoded: str, file_path: Path, message_id: str, part_id: str
+    ) -> Future:
+        """Queues an attachment to be decoded and written, waiting while
+        the queue is full.
+
+        Args:
+            encoded (str): urlsafe base64 encoded attachment data
+            file_path (Path): Output file path
+            message_id (str): Gmail message ID
+            part_id (str): Message part ID of the attachment
+
+        Returns:
+            Future: Resolves to the path the file was written to (Path)
+            and its sha256 hex digest (str)
+        """
+        future = Future()
+        # Run in the submitter's context, so the metrics go to its run
+        context = contextvars.copy_context()
+        self.jobs.put((encoded, Path(file_path), message_id, part_id, future, context))
+        return future
+
+    def write(
+        self, encoded: str, file_path: Path, message_id: str, part_id: str
+    ) -> tuple:
+        """Writes an attachment and waits for it to be written.
+
+        Returns:
+            tuple: Path the file was written to (Path) and its sha256 hex
+            digest (str)
+        """
+        return self.submit(encoded, file_path, message_id, part_id).result()
+
+    def close(self) -> None:
+        """Writes the files still queued and stops the writer thread."""
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+
+    def _run(self) -> None:
+        """Writes the queued files, in batches of those waiting."""
+        stop = False
+        while not stop:
+            batch = [self.jobs.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write_batch([job for job in batch if job is not None])
+
+    def _write_batch(self, batch: list) -> None:
+        """Writes a batch of files, syncs them as the policy says, then
+        reports them written."""
+        written = []
+        for encoded, file_path, message_id, part_id, future, context in batch:
+            try:
+                outcome = context.run(
+                    self._write, encoded, file_path, message_id, part_id
+                )
+            except BaseException as err:  # pylint: disable=broad-except
+                future.set_exception(err)
+            else:
+                written.append((future, outcome, context))
+        if self.fsync == "folder" and written:
+            written[0][2].run(
+                self._sync_batch, [outcome[0] for _, outcome, _ in written]
+            )
+        for future, outcome, _ in written:
+            future.set_result(outcome)
+
+    def _sync_batch(self, paths: list) -> None:
+        """Syncs the files of a batch, then the entries of their folders."""
+        with metrics.stage("fsync"):
+            for path in paths:
+                _sync_path(path)
+            for folder in sorted({path.parent for path in paths}):
+                _sync_path(folder)
+
+    def _folder(self, folder: Path, recheck: bool = False) -> None:
+        """Creates an output folder, unless it already was."""
+        if recheck or folder not in self.created:
+            folder.mkdir(parents=True, exist_ok=True)
+            self.created.add(folder)
+
+    def _write(
+        self, encoded: str, file_path: Path, message_id: str, part_id: str
+    ) -> tuple:
+        """Decodes and writes one file, next to it first and then renamed
+        to its name, or to its collision name if a different file has
+        the name. A duplicate of an indexed file is linked to it."""
+        self._folder(file_path.parent)
+        sync = self.fsync == "file"
+        linked = self._link(encoded, file_path, message_id, part_id)
+        if linked is not None:
+            if sync:
+                with metrics.stage("fsync"):
+                    _sync_path(file_path.parent)
+            return linked
+        try:
+            temp_path, sha256 = decode_to_temp(encoded, file_path, sync)
+        except FileNotFoundError:
+            # The folder was removed since it was created
+            self._folder(file_path.parent, recheck=True)
+            temp_path, sha256 = decode_to_temp(encoded, file_path, sync)
+        try:
+            size = temp_path.stat().st_size
+            for candidate in (
+                file_path,
+                collision_path(file_path, message_id, part_id),
+            ):
+                if self._available(candidate, size, sha256):
+                    break
+            os.replace(temp_path, candidate)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        if sync:
+            with metrics.stage("fsync"):
+                _sync_path(file_path.parent)
+        if self.index is not None:
+            self.written.setdefault(size, {})[sha256] = candidate
+        return candidate, sha256
+
+    def _link(self, encoded: str, file_path: Path, message_id: str, part_id: str):
+        """Links a file to an indexed or written file with the same
+        contents, if there is one. Only files of a size such a file has
+        are hashed.
+
+        Returns:
+            tuple: Path the file was linked at, or already is at (Path),
+            and its sha256 hex digest (str), or None if it has to be
+            written
+        """
+        if self.index is None:
+            return None
+        size = decoded_size(encoded)
+        if size not in self.written and not self.index.has_content_size(size):
+            return None
+        sha256 = decoded_digest(encoded)
+        for candidate in (file_path, collision_path(file_path, message_id, part_id)):
+            if self._available(candidate, size, sha256):
+                break
+        if candidate.exists():
+            # The same contents are already there (maybe as a link)
+            return candidate, sha256
+        original = self.written.get(size, {}).get(sha256)
+        if original is None or original == candidate:
+            original = self.index.find_content(sha256, size, candidate)
+        if original is None or not link_duplicate(candidate, original):
+            return None
+        count_linked(size)
+        return candidate, sha256
+
+    @staticmethod
+    def _available(file_path: Path, size: int, sha256: str) -> bool:
+        """Checks whether a file can be written to file_path: nothing is
+        there, or a file with the same contents."""
+        try:
+            if file_path.stat().st_size != size:
+                return False
+        except FileNotFoundError:
+            return True
+        return file_digest(file_path) == sha256